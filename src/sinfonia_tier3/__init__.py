@@ -10,6 +10,24 @@
 
 __version__ = "0.7.4.post.dev0"
 
-from .cli import sinfonia_tier3
+from typing import TYPE_CHECKING, Any
 
-__all__ = ["sinfonia_tier3"]
+if TYPE_CHECKING:
+    from .cli import sinfonia_tier3
+    from .session import sinfonia_session
+
+__all__ = ["sinfonia_tier3", "sinfonia_session"]
+
+
+def __getattr__(name: str) -> Any:
+    # imported on first use, running the namespace helpers with 'python -m'
+    # should not drag in (and re-import) the rest of the package
+    if name == "sinfonia_tier3":
+        from .cli import sinfonia_tier3
+
+        return sinfonia_tier3
+    if name == "sinfonia_session":
+        from .session import sinfonia_session
+
+        return sinfonia_session
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
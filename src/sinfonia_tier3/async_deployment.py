@@ -0,0 +1,447 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""asyncio counterparts of sinfonia_tier3 and sinfonia_runapp.
+
+The application, unshare and slirp4netns run as asyncio subprocesses and the
+orchestrator is contacted with aiohttp, so a single event loop can supervise
+many launches without a thread per application.
+
+    launch = await async_sinfonia_tier3(tier1_url, application_uuid, ["app"])
+    status = await launch   # or launch.cancel()
+
+Creating the tunnel through wireguard4netns or the sudo root helper, probing
+the path MTU, resolving the endpoint and updating the caches are blocking and
+run in the event loop's default executor, but only while a launch is being set
+up.
+
+Requires the optional aiohttp dependency, pip install sinfonia-tier3[async]
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from contextlib import asynccontextmanager, suppress
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, AsyncIterator, Generator, Mapping, Sequence
+from uuid import UUID
+
+import aiohttp
+from attrs import define, field
+from openapi_core.datatypes import RequestParameters
+from wireguard_tools import WireguardConfig
+from yarl import URL
+
+from .cloudlet_deployment import (
+    CloudletDeployment,
+    _deployment_url,
+    unmarshal_deployments,
+)
+from .key_cache import KeyCacheEntry
+from .local_deployment import namespace_launch, tunnel_backends, user_mode_network_args
+from .netns_helper import UPLINK, UPLINK_TIMEOUT
+from .tunnel_backend import TUNNEL_ERRORS, backend_failed, terminate_wireguard_go
+
+# seconds a process gets to exit after SIGTERM before it is killed
+TEARDOWN_TIMEOUT = 5
+
+
+#
+# OpenAPI validation of aiohttp requests/responses
+#
+@define
+class AiohttpOpenAPIRequest:
+    url: URL
+    method: str
+    headers: Mapping[str, str]
+    # we don't send query, header or cookie parameters
+    parameters: RequestParameters = field(factory=RequestParameters)
+
+    @property
+    def host_url(self) -> str:
+        return f"{self.url.scheme}://{self.url.raw_authority}"
+
+    @property
+    def path(self) -> str:
+        return self.url.raw_path
+
+    @property
+    def body(self) -> str | None:
+        return None
+
+    @property
+    def mimetype(self) -> str:
+        return str(
+            self.headers.get("Content-Type") or self.headers.get("Accept")
+        ).split(";")[0]
+
+
+@define
+class AiohttpOpenAPIResponse:
+    data: str
+    status_code: int
+    headers: Mapping[str, str]
+
+    @property
+    def mimetype(self) -> str:
+        return str(self.headers.get("Content-Type", "")).split(";")[0]
+
+
+@asynccontextmanager
+async def _client_session(
+    session: aiohttp.ClientSession | None,
+) -> AsyncIterator[aiohttp.ClientSession]:
+    if session is not None:
+        yield session
+        return
+    async with aiohttp.ClientSession() as new_session:
+        yield new_session
+
+
+async def _raise_for_status(response: aiohttp.ClientResponse) -> None:
+    # same as response.raise_for_status, but keep the orchestrator's explanation
+    if response.status >= 400:
+        raise aiohttp.ClientResponseError(
+            response.request_info,
+            response.history,
+            status=response.status,
+            message=await response.text(),
+            headers=response.headers,
+        )
+
+
+async def async_sinfonia_deploy(
+    tier1_url: URL,
+    application_uuid: UUID,
+    debug: bool = False,
+    zeroconf: bool = False,
+    session: aiohttp.ClientSession | None = None,
+) -> list[CloudletDeployment]:
+    """Request a backend (re)deployment from the orchestrator"""
+    if zeroconf:
+        raise NotImplementedError("Zeroconf functionality is still unfinished")
+
+    deployment_keys = KeyCacheEntry.load(application_uuid)
+    deployment_url = _deployment_url(
+        tier1_url, application_uuid, deployment_keys.public_key
+    )
+
+    if debug:
+        print("\ndeployment_url:", deployment_url)
+
+    async with _client_session(session) as client:
+        async with client.post(deployment_url) as response:
+            await _raise_for_status(response)
+            openapi_request = AiohttpOpenAPIRequest(
+                deployment_url, "post", dict(response.request_info.headers)
+            )
+            openapi_response = AiohttpOpenAPIResponse(
+                await response.text(), response.status, dict(response.headers)
+            )
+
+    # validating the response blocks
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        unmarshal_deployments,
+        openapi_request,
+        openapi_response,
+        deployment_keys.private_key,
+    )
+
+
+async def async_sinfonia_release(
+    tier1_url: URL,
+    application_uuid: UUID,
+    debug: bool = False,
+    session: aiohttp.ClientSession | None = None,
+) -> None:
+    """Tell the orchestrator we are done with the backend deployment"""
+    deployment_keys = KeyCacheEntry.load(application_uuid)
+    deployment_url = _deployment_url(
+        tier1_url, application_uuid, deployment_keys.public_key
+    )
+
+    if debug:
+        print("\nrelease_url:", deployment_url)
+
+    async with _client_session(session) as client:
+        async with client.delete(deployment_url) as response:
+            await _raise_for_status(response)
+
+
+#
+# Application lifecycle
+#
+@define
+class AsyncLaunch:
+    """Handle on an application running in its own network namespace.
+
+    Awaiting it returns the exit status once the application exited and the
+    tunnel has been torn down. Cancelling terminates the application.
+    """
+
+    deployment_name: str
+    pid: int
+    task: asyncio.Task[int]
+
+    def __await__(self) -> Generator[Any, None, int]:
+        return self.task.__await__()
+
+    def done(self) -> bool:
+        return self.task.done()
+
+    @property
+    def returncode(self) -> int | None:
+        if not self.task.done() or self.task.cancelled():
+            return None
+        if self.task.exception() is not None:
+            return None
+        return self.task.result()
+
+    def cancel(self) -> bool:
+        return self.task.cancel()
+
+
+async def _stop(proc: asyncio.subprocess.Process) -> None:
+    """Terminate proc, and kill it when it ignores that"""
+    if proc.returncode is None:
+        with suppress(ProcessLookupError):
+            proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), TEARDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+
+
+async def _teardown(
+    netns_proc: asyncio.subprocess.Process,
+    uplink_proc: asyncio.subprocess.Process | None,
+    tmpdir: TemporaryDirectory[str],
+) -> None:
+    await _stop(netns_proc)
+
+    # wireguard-go would otherwise keep the tun device and namespace alive
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, terminate_wireguard_go, Path(tmpdir.name))
+
+    if uplink_proc is not None:
+        await _stop(uplink_proc)
+
+    tmpdir.cleanup()
+
+
+async def _supervise(
+    netns_proc: asyncio.subprocess.Process,
+    uplink_proc: asyncio.subprocess.Process | None,
+    tmpdir: TemporaryDirectory[str],
+) -> int:
+    try:
+        return await netns_proc.wait()
+    finally:
+        # also when we got cancelled
+        await _teardown(netns_proc, uplink_proc, tmpdir)
+
+
+async def _start_user_mode_network(netns_pid: int) -> asyncio.subprocess.Process:
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            uplink_args = user_mode_network_args(netns_pid, UPLINK, write_fd)
+            if uplink_args is None:
+                raise RuntimeError("slirp4netns not found")
+            uplink_proc = await asyncio.create_subprocess_exec(
+                *uplink_args, pass_fds=(write_fd,)
+            )
+        finally:
+            os.close(write_fd)
+
+        # slirp4netns writes "1" once the uplink is up, or exits
+        loop = asyncio.get_running_loop()
+        readable: asyncio.Future[None] = loop.create_future()
+
+        def on_readable() -> None:
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(read_fd, on_readable)
+        try:
+            await asyncio.wait_for(readable, UPLINK_TIMEOUT)
+            ready = os.read(read_fd, 1) == b"1"
+        except asyncio.TimeoutError:
+            ready = False
+        finally:
+            loop.remove_reader(read_fd)
+    finally:
+        os.close(read_fd)
+
+    if not ready:
+        with suppress(ProcessLookupError):
+            uplink_proc.kill()
+        await uplink_proc.wait()
+        raise RuntimeError("Failed to attach user-mode network")
+    return uplink_proc
+
+
+async def async_sinfonia_runapp(
+    deployment_name: str,
+    config: WireguardConfig,
+    application: Sequence[str],
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+) -> AsyncLaunch:
+    """Start application in an isolated network namespace with wireguard tunnel.
+
+    Returns once the tunnel is up, raises RuntimeError when none of the
+    backends could create the tunnel.
+    """
+    loop = asyncio.get_running_loop()
+    tmpdir = TemporaryDirectory()
+    try:
+        launch = await loop.run_in_executor(
+            None,
+            partial(
+                namespace_launch,
+                Path(tmpdir.name),
+                deployment_name,
+                config,
+                application,
+                dns_cache=dns_cache,
+                split_tunnel=split_tunnel,
+                mtu=mtu,
+                mss_clamp=mss_clamp,
+            ),
+        )
+        backends = await loop.run_in_executor(None, tunnel_backends, tunnel_backend)
+        netns_proc = await asyncio.create_subprocess_exec(*launch.args)
+    except BaseException:
+        tmpdir.cleanup()
+        raise
+
+    uplink_proc = None
+    try:
+        for backend in backends:
+            try:
+                await loop.run_in_executor(
+                    None,
+                    backend.create,
+                    netns_proc.pid,
+                    launch.interface,
+                    launch.config,
+                    Path(tmpdir.name),
+                )
+                break
+            except ValueError as exc:
+                # the tunnel configuration, not the backend, is the problem
+                print(f"Unable to create tunnel with {backend.description}: {exc}")
+            except TUNNEL_ERRORS:
+                print(f"Failed to create tunnel with {backend.description}")
+                await loop.run_in_executor(None, backend_failed, backend.name)
+        else:
+            raise RuntimeError("Failed to create tunnel")
+
+        if launch.uplink:
+            uplink_proc = await _start_user_mode_network(netns_proc.pid)
+    except BaseException:
+        await _teardown(netns_proc, uplink_proc, tmpdir)
+        raise
+
+    return AsyncLaunch(
+        deployment_name,
+        netns_proc.pid,
+        asyncio.ensure_future(_supervise(netns_proc, uplink_proc, tmpdir)),
+    )
+
+
+async def _release(
+    tier1_url: URL,
+    application_uuid: UUID,
+    debug: bool,
+    session: aiohttp.ClientSession | None,
+) -> None:
+    # tier2 will still clean up once it notices the tunnel is idle
+    with suppress(aiohttp.ClientError):
+        await async_sinfonia_release(tier1_url, application_uuid, debug, session)
+
+
+async def _release_after(
+    launch: AsyncLaunch,
+    tier1_url: URL,
+    application_uuid: UUID,
+    debug: bool,
+    session: aiohttp.ClientSession | None,
+) -> int:
+    try:
+        return await launch
+    finally:
+        await _release(tier1_url, application_uuid, debug, session)
+
+
+async def async_sinfonia_tier3(
+    tier1_url: URL | str,
+    application_uuid: UUID,
+    application: Sequence[str],
+    debug: bool = False,
+    zeroconf: bool = False,
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+    release: bool = True,
+    session: aiohttp.ClientSession | None = None,
+) -> AsyncLaunch:
+    """Deploy a backend and start application connected to it.
+
+    Raises aiohttp.ClientError when the deployment fails. When release is set
+    the deployment is released after the application exits, or right away
+    when the application could not be started. A session that is passed in is
+    also used for the release, so it should stay open until then.
+    """
+    deployments = await async_sinfonia_deploy(
+        URL(tier1_url), application_uuid, debug, zeroconf, session
+    )
+
+    # Pick the best deployment (first returned for now...)
+    deployment_data = deployments[0]
+
+    try:
+        launch = await async_sinfonia_runapp(
+            deployment_data.deployment_name,
+            deployment_data.tunnel_config,
+            application,
+            dns_cache=dns_cache,
+            split_tunnel=split_tunnel,
+            mtu=mtu,
+            mss_clamp=mss_clamp,
+            tunnel_backend=tunnel_backend,
+        )
+    except BaseException:
+        if release:
+            await _release(URL(tier1_url), application_uuid, debug, session)
+        raise
+
+    if not release:
+        return launch
+
+    return AsyncLaunch(
+        launch.deployment_name,
+        launch.pid,
+        asyncio.ensure_future(
+            _release_after(launch, URL(tier1_url), application_uuid, debug, session)
+        ),
+    )
@@ -0,0 +1,216 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Find and remove what crashed or killed runs may have left behind.
+
+- wireguard-go processes whose temporary directory is gone, they keep the
+  tun device (and with it the network namespace) alive.
+- slirp4netns processes for a network namespace that no longer exists.
+- wg-* wireguard interfaces created by the root helper that never made it
+  into a network namespace.
+- wg.conf/resolv.conf written by --config-debug for one of our cached keys.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+from pathlib import Path
+from shutil import which
+from typing import Callable, Sequence
+
+import importlib_resources
+from attrs import define
+from pyroute2 import IPRoute
+from wireguard_tools import WireguardConfig
+from xdg import xdg_cache_home
+
+from .key_cache import KeyCacheEntry
+from .netns_helper import UPLINK
+
+
+@define
+class StaleResource:
+    description: str
+    remove: Callable[[], None]
+
+
+def _own_processes() -> list[tuple[int, list[str]]]:
+    processes = []
+    for proc in Path("/proc").glob("[0-9]*"):
+        try:
+            if proc.stat().st_uid != os.getuid():
+                continue
+            cmdline = (proc / "cmdline").read_bytes().decode().split("\0")
+        except (OSError, UnicodeError):
+            continue
+        processes.append((int(proc.name), [arg for arg in cmdline if arg]))
+    return processes
+
+
+def _terminate(pid: int) -> Callable[[], None]:
+    def terminate() -> None:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    return terminate
+
+
+def stale_processes() -> list[StaleResource]:
+    # only the wireguard-go that wireguard4netns starts for our wg-* interfaces
+    wireguard_go = str(
+        importlib_resources.files("wireguard4netns").joinpath("wireguard-go")
+    )
+
+    stale = []
+    for pid, cmdline in _own_processes():
+        if not cmdline:
+            continue
+        program = Path(cmdline[0]).name
+
+        if (
+            cmdline[0] == wireguard_go
+            and len(cmdline) == 2
+            and cmdline[1].startswith("wg-")
+        ):
+            # runs in the temporary directory that held its uapi socket
+            try:
+                cwd = os.readlink(f"/proc/{pid}/cwd")
+            except OSError:
+                continue
+            if cwd.endswith(" (deleted)") or not Path(cwd).exists():
+                stale.append(
+                    StaleResource(
+                        f"wireguard-go {cmdline[1]} (pid {pid})", _terminate(pid)
+                    )
+                )
+
+        elif program == "slirp4netns" and cmdline[-1] == UPLINK:
+            netns_pid = cmdline[-2]
+            if netns_pid.isdigit() and not Path("/proc", netns_pid).exists():
+                stale.append(StaleResource(f"slirp4netns (pid {pid})", _terminate(pid)))
+    return stale
+
+
+def _sudo_delete_interface(interface: str) -> Callable[[], None]:
+    def delete() -> None:
+        sudo = which("sudo")
+        assert sudo is not None
+        subprocess.run(
+            [
+                sudo,
+                sys.executable,
+                "-m",
+                "sinfonia_tier3.root_helper",
+                "--delete",
+                interface,
+            ],
+            check=True,
+        )
+
+    return delete
+
+
+def stale_interfaces() -> list[StaleResource]:
+    """wg-* interfaces in this namespace without any addresses"""
+    stale = []
+    with IPRoute() as ipr:
+        for link in ipr.get_links():
+            interface = link.get_attr("IFLA_IFNAME")
+            linkinfo = link.get_attr("IFLA_LINKINFO")
+            kind = linkinfo.get_attr("IFLA_INFO_KIND") if linkinfo else None
+            if not interface.startswith("wg-") or kind != "wireguard":
+                continue
+            if ipr.get_addr(index=link["index"]):
+                continue
+            stale.append(
+                StaleResource(
+                    f"wireguard interface {interface}",
+                    _sudo_delete_interface(interface),
+                )
+            )
+    return stale
+
+
+def _unlink(path: Path) -> Callable[[], None]:
+    def unlink() -> None:
+        path.unlink()
+
+    return unlink
+
+
+def stale_config_files(directory: Path) -> list[StaleResource]:
+    """wg.conf and resolv.conf written by --config-debug"""
+    wireguard_conf = directory / "wg.conf"
+    try:
+        with wireguard_conf.open() as fh:
+            config = WireguardConfig.from_wgconfig(fh)
+    except (OSError, ValueError):
+        return []
+
+    # only remove the config if the private key is one of our cached keys
+    private_keys = set()
+    for cache_file in (xdg_cache_home() / "sinfonia").glob("*-*-*-*-*"):
+        try:
+            private_keys.add(KeyCacheEntry.from_file(cache_file).private_key)
+        except (OSError, ValueError):
+            continue
+    if config.private_key not in private_keys:
+        return []
+
+    stale = [StaleResource(f"config file {wireguard_conf}", _unlink(wireguard_conf))]
+
+    resolv_conf = directory / "resolv.conf"
+    try:
+        lines = resolv_conf.read_text().splitlines()
+    except OSError:
+        return stale
+    if lines and all(
+        line.split(" ", 1)[0] in ("nameserver", "search", "options") for line in lines
+    ):
+        stale.append(StaleResource(f"config file {resolv_conf}", _unlink(resolv_conf)))
+    return stale
+
+
+def find_stale_resources(directory: Path) -> list[StaleResource]:
+    return stale_processes() + stale_interfaces() + stale_config_files(directory)
+
+
+def cleanup_main(args: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="sinfonia-tier3 cleanup")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only list what would be removed",
+    )
+    parser.add_argument(
+        "--directory",
+        type=Path,
+        default=Path(),
+        help="Where to look for --config-debug files (default: current directory)",
+    )
+    parsed = parser.parse_args(args)
+
+    status = 0
+    for resource in find_stale_resources(parsed.directory):
+        if parsed.dry_run:
+            print(f"Would remove {resource.description}")
+            continue
+        try:
+            resource.remove()
+            print(f"Removed {resource.description}")
+        except (AssertionError, OSError, subprocess.CalledProcessError):
+            print(f"Failed to remove {resource.description}")
+            status = 1
+    return status
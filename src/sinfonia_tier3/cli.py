@@ -11,16 +11,19 @@
 from __future__ import annotations
 
 import argparse
+import sys
 from io import StringIO
 from typing import Sequence
 from uuid import UUID
 
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 from yarl import URL
 
 from . import __version__
-from .cloudlet_deployment import sinfonia_deploy
+from .cleanup import cleanup_main
+from .cloudlet_deployment import sinfonia_deploy, sinfonia_release
 from .local_deployment import sinfonia_runapp
+from .tunnel_backend import BACKENDS
 
 ALIASES = {
     "helloworld": "00000000-0000-0000-0000-000000000000",
@@ -34,7 +37,9 @@ def app_uuid(value: str) -> UUID:
 
 def parse_args(args: list[str] | None = None) -> argparse.Namespace:
     """parse those args"""
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog="Use '%(prog)s cleanup' to remove leftovers from earlier runs",
+    )
     parser.add_argument(
         "--config-debug",
         action="store_true",
@@ -43,6 +48,36 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
     parser.add_argument(
         "--debug", action="store_true", help="Extra logging for debugging"
     )
+    parser.add_argument(
+        "--dns-cache",
+        action="store_true",
+        help="Run a caching DNS forwarder inside the network namespace",
+    )
+    parser.add_argument(
+        "--no-release",
+        action="store_true",
+        help="Do not release the backend deployment when the application exits",
+    )
+    parser.add_argument(
+        "--mtu",
+        type=int,
+        help="Tunnel MTU (default: probe the path MTU to the cloudlet)",
+    )
+    parser.add_argument(
+        "--mss-clamp",
+        action="store_true",
+        help="Clamp TCP MSS to the path MTU inside the network namespace",
+    )
+    parser.add_argument(
+        "--tunnel-backend",
+        choices=list(BACKENDS),
+        help="WireGuard implementation (default: fastest working on this host)",
+    )
+    parser.add_argument(
+        "--split-tunnel",
+        action="store_true",
+        help="Only route traffic for the backend through the tunnel",
+    )
     parser.add_argument(
         "--version", action="version", version=f"%(prog)s {__version__}"
     )
@@ -70,6 +105,12 @@ def sinfonia_tier3(
     debug: bool = False,
     qrcode: str | None = None,
     zeroconf: bool = False,
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+    release: bool = True,
 ) -> int:
     # Request one or more backend deployments
     try:
@@ -101,15 +142,34 @@ def sinfonia_tier3(
             print(s.getvalue())
         return 0
 
-    return sinfonia_runapp(
-        deployment_data.deployment_name,
-        deployment_data.tunnel_config,
-        application,
-        config_debug,
-    )
+    try:
+        return sinfonia_runapp(
+            deployment_data.deployment_name,
+            deployment_data.tunnel_config,
+            application,
+            config_debug,
+            dns_cache=dns_cache,
+            split_tunnel=split_tunnel,
+            mtu=mtu,
+            mss_clamp=mss_clamp,
+            tunnel_backend=tunnel_backend,
+        )
+    finally:
+        # free the cloudlet resources now instead of when tier2 notices the
+        # tunnel has been idle, also when the application was interrupted
+        if release and not config_debug:
+            try:
+                print("Releasing... ", end="", flush=True)
+                sinfonia_release(URL(tier1_url), application_uuid, debug)
+                print("done")
+            except RequestException as e:
+                print(f"failed ({e})")
 
 
 def main() -> int:
+    if sys.argv[1:2] == ["cleanup"]:
+        return cleanup_main(sys.argv[2:])
+
     args = parse_args()
     return sinfonia_tier3(
         args.tier1_url,
@@ -119,4 +179,10 @@ def main() -> int:
         debug=args.debug,
         qrcode=args.qrcode,
         zeroconf=args.zeroconf,
+        dns_cache=args.dns_cache,
+        split_tunnel=args.split_tunnel,
+        mtu=args.mtu,
+        mss_clamp=args.mss_clamp,
+        tunnel_backend=args.tunnel_backend,
+        release=not args.no_release,
     )
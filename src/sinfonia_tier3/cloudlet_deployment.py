@@ -22,6 +22,7 @@ from openapi_core.contrib.requests import (
     RequestsOpenAPIRequest,
     RequestsOpenAPIResponse,
 )
+from openapi_core.protocols import Request, Response
 from wireguard_tools import WireguardConfig, WireguardKey
 from yarl import URL
 
@@ -81,31 +82,16 @@ def unmarshal_wireguard_key(value: str) -> WireguardKey:
     return WireguardKey(value)
 
 
-def sinfonia_deploy(
-    tier1_url: URL, application_uuid: UUID, debug: bool = False, zeroconf: bool = False
-) -> list[CloudletDeployment]:
-    """Request a backend (re)deployment from the orchestrator"""
-    deploy_base = tier1_url
-    if zeroconf:
-        raise NotImplementedError("Zeroconf functionality is still unfinished")
-        # - perform MDNS lookup for "cloudlet._sinfonia._tcp.local."
-        # override tier1_url and pass original tier1_url as a request header
-
-    deployment_keys = KeyCacheEntry.load(application_uuid)
-    deployment_url = (
-        deploy_base
-        / "api/v1/deploy"
-        / str(application_uuid)
-        / deployment_keys.public_key.urlsafe
-    )
-
-    if debug:
-        print("\ndeployment_url:", deployment_url)
+def _deployment_url(
+    tier1_url: URL, application_uuid: UUID, public_key: WireguardKey
+) -> URL:
+    return tier1_url / "api/v1/deploy" / str(application_uuid) / public_key.urlsafe
 
-    # fire off deployment request
-    response = requests.post(str(deployment_url))
-    response.raise_for_status()
 
+def unmarshal_deployments(
+    openapi_request: Request, openapi_response: Response, private_key: WireguardKey
+) -> list[CloudletDeployment]:
+    """Validate the orchestrator's response and unpack the deployments"""
     # load openapi specification to validate the response
     spec_text = (
         importlib_resources.files("sinfonia_tier3.openapi")
@@ -115,10 +101,6 @@ def sinfonia_deploy(
     spec_dict = yaml.safe_load(spec_text)
     spec = Spec.create(spec_dict)
 
-    # create request/response wrappers for validation
-    openapi_request = RequestsOpenAPIRequest(response.request)
-    openapi_response = RequestsOpenAPIResponse(response)
-
     # validate and unpack the response
     extra_validators = dict(wireguard_public_key=validate_wireguard_key)
     extra_unmarshallers = dict(wireguard_public_key=unmarshal_wireguard_key)
@@ -133,6 +115,55 @@ def sinfonia_deploy(
     # validation should have failed if this is None, I think
     assert result.data is not None
     return [
-        CloudletDeployment.from_dict(deployment_keys.private_key, deployment)
+        CloudletDeployment.from_dict(private_key, deployment)
         for deployment in cast(Any, result.data)
     ]
+
+
+def sinfonia_deploy(
+    tier1_url: URL, application_uuid: UUID, debug: bool = False, zeroconf: bool = False
+) -> list[CloudletDeployment]:
+    """Request a backend (re)deployment from the orchestrator"""
+    deploy_base = tier1_url
+    if zeroconf:
+        raise NotImplementedError("Zeroconf functionality is still unfinished")
+        # - perform MDNS lookup for "cloudlet._sinfonia._tcp.local."
+        # override tier1_url and pass original tier1_url as a request header
+
+    deployment_keys = KeyCacheEntry.load(application_uuid)
+    deployment_url = _deployment_url(
+        deploy_base, application_uuid, deployment_keys.public_key
+    )
+
+    if debug:
+        print("\ndeployment_url:", deployment_url)
+
+    # fire off deployment request
+    response = requests.post(str(deployment_url))
+    response.raise_for_status()
+
+    return unmarshal_deployments(
+        RequestsOpenAPIRequest(response.request),
+        RequestsOpenAPIResponse(response),
+        deployment_keys.private_key,
+    )
+
+
+def sinfonia_release(
+    tier1_url: URL, application_uuid: UUID, debug: bool = False
+) -> None:
+    """Tell the orchestrator we are done with the backend deployment
+
+    Without this the cloudlet only frees the resources once it notices the
+    tunnel has been idle for a while.
+    """
+    deployment_keys = KeyCacheEntry.load(application_uuid)
+    deployment_url = _deployment_url(
+        tier1_url, application_uuid, deployment_keys.public_key
+    )
+
+    if debug:
+        print("\nrelease_url:", deployment_url)
+
+    response = requests.delete(str(deployment_url))
+    response.raise_for_status()
@@ -0,0 +1,522 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Small caching DNS forwarder that runs on 127.0.0.1 in the network namespace.
+
+Every lookup from the frontend otherwise crosses the WireGuard tunnel, and with
+`options ndots:5` a single short name turns into a query for every search
+domain. The forwarder,
+
+- caches positive answers for the minimum TTL of the answer section, and
+  counts down the TTLs of cached answers so clients don't keep them longer,
+- caches negative answers (NXDOMAIN/NODATA) based on the SOA record in the
+  authority section (RFC 2308),
+- collapses search-domain expansion, when a query arrives for the first
+  candidate of the search list all candidates are resolved in parallel and the
+  first successful one is returned as a CNAME (similar to CoreDNS autopath).
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import random
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from typing import Sequence, Tuple, cast
+
+from attrs import define, field
+
+DNS_PORT = 53
+MAX_UDP_SIZE = 512
+MAX_CACHE_TTL = 3600
+MAX_CACHE_ENTRIES = 1024
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+HEADER = struct.Struct("!HHHHHH")
+RR_FIXED = struct.Struct("!HHIH")
+
+
+#
+# Minimal DNS message parsing/encoding
+#
+def read_name(msg: bytes, offset: int) -> tuple[str, int]:
+    """Decode a (possibly compressed) domain name, returns name and new offset"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = msg[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise ValueError("DNS name compression loop")
+            offset = ((length & 0x3F) << 8) | msg[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(msg[offset : offset + length].decode("ascii", "replace"))
+        offset += length
+    return ".".join(labels), end if end is not None else offset
+
+
+def encode_name(name: str) -> bytes:
+    labels = [label.encode("ascii") for label in name.rstrip(".").split(".") if label]
+    return b"".join(bytes([len(label)]) + label for label in labels) + b"\0"
+
+
+@define
+class ResourceRecord:
+    name: str
+    rtype: int
+    rclass: int
+    ttl: int
+    rdata: bytes
+    # uncompressed target name for CNAME records, minimum ttl for SOA records
+    target: str | None = None
+    minimum: int | None = None
+
+    def to_wire(self) -> bytes:
+        rdata = encode_name(self.target) if self.target is not None else self.rdata
+        return (
+            encode_name(self.name)
+            + RR_FIXED.pack(self.rtype, self.rclass, self.ttl, len(rdata))
+            + rdata
+        )
+
+
+@define
+class DnsMessage:
+    ident: int
+    flags: int
+    question: tuple[str, int, int] | None
+    answers: list[ResourceRecord] = field(factory=list)
+    authority: list[ResourceRecord] = field(factory=list)
+    additional_count: int = 0
+
+    @property
+    def rcode(self) -> int:
+        return self.flags & 0x000F
+
+    @classmethod
+    def parse(cls, msg: bytes) -> DnsMessage:
+        """Parse header, question, answer and authority sections.
+
+        raises ValueError when the message is malformed.
+        """
+        try:
+            ident, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(msg)
+            offset = HEADER.size
+
+            question = None
+            for _ in range(qdcount):
+                qname, offset = read_name(msg, offset)
+                qtype, qclass = struct.unpack_from("!HH", msg, offset)
+                offset += 4
+                if question is None:
+                    question = (qname, qtype, qclass)
+
+            sections: list[list[ResourceRecord]] = [[], []]
+            for section, count in zip(sections, (ancount, nscount)):
+                for _ in range(count):
+                    record, offset = cls._parse_rr(msg, offset)
+                    section.append(record)
+        except (IndexError, struct.error, UnicodeError) as exc:
+            raise ValueError("Malformed DNS message") from exc
+        return cls(ident, flags, question, sections[0], sections[1], arcount)
+
+    @staticmethod
+    def _parse_rr(msg: bytes, offset: int) -> tuple[ResourceRecord, int]:
+        name, offset = read_name(msg, offset)
+        rtype, rclass, ttl, rdlength = RR_FIXED.unpack_from(msg, offset)
+        offset += RR_FIXED.size
+        rdata = msg[offset : offset + rdlength]
+        if len(rdata) != rdlength:
+            raise IndexError("truncated rdata")
+
+        record = ResourceRecord(name, rtype, rclass, ttl, rdata)
+        if rtype == TYPE_CNAME:
+            record.target, _ = read_name(msg, offset)
+        elif rtype == TYPE_SOA:
+            _mname, soa_offset = read_name(msg, offset)
+            _rname, soa_offset = read_name(msg, soa_offset)
+            (record.minimum,) = struct.unpack_from("!I", msg, soa_offset + 16)
+        return record, offset + rdlength
+
+
+def ttl_offsets(msg: bytes) -> list[int]:
+    """Offsets of the TTL fields of all resource records in a message,
+    except for the EDNS OPT pseudo-record which uses it for flags.
+
+    raises ValueError when the message is malformed.
+    """
+    try:
+        _ident, _flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(msg)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            _qname, offset = read_name(msg, offset)
+            offset += 4
+
+        offsets = []
+        for _ in range(ancount + nscount + arcount):
+            _name, offset = read_name(msg, offset)
+            rtype, _rclass, _ttl, rdlength = RR_FIXED.unpack_from(msg, offset)
+            if rtype != TYPE_OPT:
+                offsets.append(offset + 4)
+            offset += RR_FIXED.size + rdlength
+            if offset > len(msg):
+                raise IndexError("truncated rdata")
+    except (IndexError, struct.error) as exc:
+        raise ValueError("Malformed DNS message") from exc
+    return offsets
+
+
+def with_ttls_aged(msg: bytes, offsets: Sequence[int], age: int) -> bytes:
+    """Subtract age seconds from the TTLs at offsets"""
+    if age <= 0:
+        return msg
+    aged = bytearray(msg)
+    for offset in offsets:
+        (ttl,) = struct.unpack_from("!I", aged, offset)
+        struct.pack_into("!I", aged, offset, max(ttl - age, 0))
+    return bytes(aged)
+
+
+def make_query(qname: str, qtype: int, qclass: int = CLASS_IN) -> bytes:
+    ident = random.getrandbits(16)
+    return (
+        HEADER.pack(ident, FLAG_RD, 1, 0, 0, 0)
+        + encode_name(qname)
+        + struct.pack("!HH", qtype, qclass)
+    )
+
+
+def make_response(
+    query: DnsMessage, rcode: int, answers: Sequence[ResourceRecord] = ()
+) -> bytes:
+    flags = FLAG_QR | (query.flags & FLAG_RD) | 0x0080 | rcode  # RA
+    msg = HEADER.pack(
+        query.ident, flags, 1 if query.question else 0, len(answers), 0, 0
+    )
+    if query.question is not None:
+        qname, qtype, qclass = query.question
+        msg += encode_name(qname) + struct.pack("!HH", qtype, qclass)
+    return msg + b"".join(answer.to_wire() for answer in answers)
+
+
+def with_ident(msg: bytes, ident: int) -> bytes:
+    return struct.pack("!H", ident) + msg[2:]
+
+
+def cache_ttl(response: DnsMessage) -> int:
+    """How long a response may be cached, 0 if it should not be cached."""
+    if response.flags & FLAG_TC:
+        return 0
+
+    if response.rcode == RCODE_NOERROR and response.answers:
+        ttl = min(record.ttl for record in response.answers)
+    elif response.rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        # negative answers are cached based on the SOA in the authority section
+        soa = [record for record in response.authority if record.rtype == TYPE_SOA]
+        if not soa:
+            return 0
+        ttl = min(soa[0].ttl, soa[0].minimum or 0)
+    else:
+        return 0
+    return max(0, min(ttl, MAX_CACHE_TTL))
+
+
+#
+# Caching resolver
+#
+CacheKey = Tuple[str, int, int]
+
+
+@define
+class CacheEntry:
+    stored: float
+    expires: float
+    response: bytes
+    ttl_offsets: list[int]
+
+    def aged_response(self, now: float) -> bytes:
+        return with_ttls_aged(self.response, self.ttl_offsets, int(now - self.stored))
+
+
+class DnsCache:
+    def __init__(
+        self,
+        nameservers: Sequence[IPv4Address | IPv6Address | str],
+        search_domains: Sequence[str] = (),
+        timeout: float = 2.0,
+    ) -> None:
+        self.nameservers = [ip_address(nameserver) for nameserver in nameservers]
+        self.search_domains = [
+            domain.strip(".").lower() for domain in search_domains if domain.strip(".")
+        ]
+        self.timeout = timeout
+        self._cache: dict[CacheKey, CacheEntry] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=8)
+
+    def resolve(self, query: bytes) -> bytes:
+        """Return the response for a client query"""
+        request = DnsMessage.parse(query)
+        if request.question is None:
+            return make_response(request, RCODE_SERVFAIL)
+
+        qname, qtype, qclass = request.question
+        base = self._search_base(qname, qtype)
+        if base is not None:
+            return self._resolve_search(request, base)
+
+        response = self._lookup(qname, qtype, qclass, query)
+        return with_ident(response, request.ident)
+
+    def _search_base(self, qname: str, qtype: int) -> str | None:
+        """Return the name the resolver expanded with the first search domain"""
+        if not self.search_domains or qtype not in (TYPE_A, TYPE_AAAA):
+            return None
+        suffix = "." + self.search_domains[0]
+        name = qname.rstrip(".")
+        if not name.lower().endswith(suffix) or len(name) == len(suffix):
+            return None
+        return name[: -len(suffix)]
+
+    def _resolve_search(self, request: DnsMessage, base: str) -> bytes:
+        assert request.question is not None
+        qname, qtype, qclass = request.question
+
+        candidates = [f"{base}.{domain}" for domain in self.search_domains] + [base]
+        lookups = [
+            self._executor.submit(self._lookup, candidate, qtype, qclass)
+            for candidate in candidates
+        ]
+
+        # only wait for a candidate when all earlier ones failed, the remaining
+        # lookups still finish in the background and end up in the cache
+        for index, lookup in enumerate(lookups):
+            response = DnsMessage.parse(lookup.result())
+            if response.rcode != RCODE_NOERROR or not response.answers:
+                continue
+            if index == 0:
+                break
+            if any(
+                answer.rtype not in (TYPE_A, TYPE_AAAA, TYPE_CNAME)
+                for answer in response.answers
+            ):
+                # we only re-encode simple address answers
+                break
+
+            ttl = min(answer.ttl for answer in response.answers)
+            cname = ResourceRecord(
+                qname, TYPE_CNAME, qclass, ttl, b"", target=candidates[index]
+            )
+            synthesized = make_response(
+                request, RCODE_NOERROR, [cname] + response.answers
+            )
+            if len(synthesized) <= MAX_UDP_SIZE:
+                return synthesized
+            break
+        return with_ident(lookups[0].result(), request.ident)
+
+    def _lookup(
+        self, qname: str, qtype: int, qclass: int, query: bytes | None = None
+    ) -> bytes:
+        """Return a cached or forwarded response, identifier is unspecified"""
+        key = (qname.rstrip(".").lower(), qtype, qclass)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry.expires > now:
+                return entry.aged_response(now)
+            self._cache.pop(key, None)
+
+        if query is None:
+            query = make_query(qname, qtype, qclass)
+        response = self.forward(query)
+
+        try:
+            ttl = cache_ttl(DnsMessage.parse(response))
+            offsets = ttl_offsets(response)
+        except ValueError:
+            ttl = 0
+        if ttl and len(response) <= MAX_UDP_SIZE:
+            with self._lock:
+                self._make_room(now)
+                self._cache[key] = CacheEntry(now, now + ttl, response, offsets)
+        return response
+
+    def _make_room(self, now: float) -> None:
+        """Drop expired entries, and the oldest ones when the cache is full"""
+        if len(self._cache) < MAX_CACHE_ENTRIES:
+            return
+        for key in [key for key, entry in self._cache.items() if entry.expires <= now]:
+            del self._cache[key]
+        while len(self._cache) >= MAX_CACHE_ENTRIES:
+            del self._cache[next(iter(self._cache))]
+
+    def forward(self, query: bytes) -> bytes:
+        """Send query to the upstream nameservers over UDP"""
+        ident = random.getrandbits(16)
+        query = with_ident(query, ident)
+
+        for nameserver in self.nameservers:
+            family = socket.AF_INET6 if nameserver.version == 6 else socket.AF_INET
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect((str(nameserver), DNS_PORT))
+                    sock.send(query)
+                    while True:
+                        response = sock.recv(65535)
+                        if response[:2] == query[:2]:
+                            return response
+                except OSError:
+                    continue
+        return make_response(DnsMessage.parse(query), RCODE_SERVFAIL)
+
+    def forward_tcp(self, query: bytes) -> bytes:
+        """Send (truncated) query to the upstream nameservers over TCP"""
+        for nameserver in self.nameservers:
+            try:
+                with socket.create_connection(
+                    (str(nameserver), DNS_PORT), timeout=self.timeout
+                ) as sock:
+                    sock.sendall(struct.pack("!H", len(query)) + query)
+                    return _recv_tcp_message(sock)
+            except OSError:
+                continue
+        return make_response(DnsMessage.parse(query), RCODE_SERVFAIL)
+
+
+def _recv_exactly(sock: socket.socket, length: int) -> bytes:
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def _recv_tcp_message(sock: socket.socket) -> bytes:
+    (length,) = struct.unpack("!H", _recv_exactly(sock, 2))
+    return _recv_exactly(sock, length)
+
+
+#
+# Servers
+#
+class _UDPHandler(socketserver.BaseRequestHandler):
+    server: DnsCacheUDPServer
+
+    def handle(self) -> None:
+        data, sock = cast(Tuple[bytes, socket.socket], self.request)
+        try:
+            response = self.server.cache.resolve(data)
+        except ValueError:
+            return
+        sock.sendto(response, self.client_address)
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+    server: DnsCacheTCPServer
+
+    def handle(self) -> None:
+        sock = cast(socket.socket, self.request)
+        sock.settimeout(10)
+        try:
+            while True:
+                query = _recv_tcp_message(sock)
+                response = self.server.cache.forward_tcp(query)
+                sock.sendall(struct.pack("!H", len(response)) + response)
+        except (OSError, ValueError):
+            pass
+
+
+class DnsCacheUDPServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], cache: DnsCache) -> None:
+        self.cache = cache
+        super().__init__(address, _UDPHandler)
+
+
+class DnsCacheTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int], cache: DnsCache) -> None:
+        self.cache = cache
+        super().__init__(address, _TCPHandler)
+
+
+def _set_parent_death_signal(signum: int) -> None:
+    """Make sure we get killed when the application exits"""
+    PR_SET_PDEATHSIG = 1
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.prctl(PR_SET_PDEATHSIG, signum)
+
+
+def fork_dns_cache(
+    nameservers: Sequence[IPv4Address | IPv6Address | str],
+    search_domains: Sequence[str] = (),
+    address: str = "127.0.0.1",
+) -> int:
+    """Start the caching forwarder in a child process.
+
+    The sockets are bound before forking so the resolver is usable as soon as
+    this returns. The child exits when the calling process (or whatever it
+    exec'd into) terminates.
+    """
+    cache = DnsCache(nameservers, search_domains)
+    udp_server = DnsCacheUDPServer((address, DNS_PORT), cache)
+    tcp_server = DnsCacheTCPServer((address, DNS_PORT), cache)
+
+    parent = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        _set_parent_death_signal(signal.SIGTERM)
+        if os.getppid() != parent:
+            os._exit(0)
+        try:
+            threading.Thread(target=tcp_server.serve_forever, daemon=True).start()
+            udp_server.serve_forever()
+        finally:
+            os._exit(0)
+
+    udp_server.server_close()
+    tcp_server.server_close()
+    return pid
@@ -0,0 +1,222 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Pick the address of a dual-stack cloudlet's WireGuard endpoint.
+
+WireGuard resolves a hostname endpoint once and uses the first address it
+gets back, even when that path is broken. Similar to Happy Eyeballs (RFC 8305)
+we resolve IPv6 and IPv4 addresses concurrently, interleave them, and send
+staggered ICMP echo requests to each. The first address to answer is pinned
+in the tunnel configuration. When nothing answers (or we are not allowed to
+send pings) we fall back on the first address we have a route to.
+
+An address that answered is cached per endpoint in
+~/.cache/sinfonia/endpoints.yaml, so a flaky IPv6 path only costs us once in a
+while. The fallback is not cached, we race again the next time.
+"""
+
+from __future__ import annotations
+
+import selectors
+import socket
+import struct
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ipaddress import IPv6Address, ip_address
+
+from attrs import evolve
+from wireguard_tools import WireguardConfig
+
+from .path_mtu import ICMP_ECHO_REQUEST, ICMPV6_ECHO_REQUEST
+from .yaml_cache import cache_file, load_cache, save_cache
+
+# RFC 8305 recommended values
+RESOLUTION_DELAY = 0.05
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+RACE_TIMEOUT = 2.0
+ENDPOINT_CACHE = "endpoints.yaml"
+ENDPOINT_CACHE_TIMEOUT = 60 * 60
+
+
+def _getaddrinfo(host: str, port: int, family: socket.AddressFamily) -> list[str]:
+    try:
+        addrinfo = socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM)
+    except OSError:
+        return []
+    # getaddrinfo already sorted them by preference (RFC 6724)
+    return list(dict.fromkeys(str(sockaddr[0]) for *_, sockaddr in addrinfo))
+
+
+def resolve_addresses(host: str, port: int) -> list[str]:
+    """Resolve IPv6 and IPv4 addresses concurrently and interleave them,
+    starting with IPv6."""
+    executor = ThreadPoolExecutor(max_workers=2)
+    ipv6 = executor.submit(_getaddrinfo, host, port, socket.AF_INET6)
+    ipv4 = executor.submit(_getaddrinfo, host, port, socket.AF_INET)
+
+    wait([ipv6, ipv4], return_when=FIRST_COMPLETED)
+    if ipv6.done():
+        wait([ipv4])
+    else:
+        # the IPv4 answer came in first, give IPv6 a moment to catch up
+        wait([ipv6], timeout=RESOLUTION_DELAY)
+    executor.shutdown(wait=False)
+
+    ipv6_addresses = ipv6.result() if ipv6.done() else []
+    ipv4_addresses = ipv4.result() if ipv4.done() else []
+
+    addresses = []
+    for index in range(max(len(ipv6_addresses), len(ipv4_addresses))):
+        addresses.extend(ipv6_addresses[index : index + 1])
+        addresses.extend(ipv4_addresses[index : index + 1])
+    return addresses
+
+
+def _probe_socket(address: str) -> socket.socket:
+    """Send an ICMP echo request to address, the returned socket becomes
+    readable when the reply comes in.
+
+    raises OSError when we are not allowed to, or cannot, send the request.
+    """
+    if isinstance(ip_address(address), IPv6Address):
+        family, proto, echo_type = (
+            socket.AF_INET6,
+            socket.IPPROTO_ICMPV6,
+            ICMPV6_ECHO_REQUEST,
+        )
+    else:
+        family, proto, echo_type = (
+            socket.AF_INET,
+            socket.IPPROTO_ICMP,
+            ICMP_ECHO_REQUEST,
+        )
+
+    sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+    try:
+        sock.setblocking(False)
+        sock.connect((address, 0))
+        sock.send(struct.pack("!BBHHH", echo_type, 0, 0, 0, 1))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def race_addresses(
+    addresses: list[str],
+    delay: float = CONNECTION_ATTEMPT_DELAY,
+    timeout: float = RACE_TIMEOUT,
+) -> str | None:
+    """Probe addresses in order, starting the next probe after delay seconds
+    or as soon as the previous one failed. Returns the first address that
+    answers."""
+    pending = list(addresses)
+    deadline = time.monotonic() + timeout
+    next_attempt = time.monotonic()
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while True:
+                now = time.monotonic()
+                if now > deadline:
+                    return None
+
+                if pending and now >= next_attempt:
+                    address = pending.pop(0)
+                    try:
+                        sock = _probe_socket(address)
+                    except OSError:
+                        continue
+                    selector.register(sock, selectors.EVENT_READ, address)
+                    next_attempt = now + delay
+                    continue
+
+                if not pending and not selector.get_map():
+                    return None
+
+                wake_up = min(next_attempt, deadline) if pending else deadline
+                for key, _ in selector.select(max(wake_up - now, 0)):
+                    sock = key.fileobj  # type: ignore[assignment]
+                    try:
+                        sock.recv(65535)
+                        return str(key.data)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        # unreachable, don't wait to start the next attempt
+                        selector.unregister(sock)
+                        sock.close()
+                        next_attempt = time.monotonic()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()  # type: ignore[union-attr]
+
+
+def _routable(address: str, port: int) -> bool:
+    family = (
+        socket.AF_INET6
+        if isinstance(ip_address(address), IPv6Address)
+        else socket.AF_INET
+    )
+    try:
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect((address, port))
+        return True
+    except OSError:
+        return False
+
+
+def pick_endpoint_address(host: str, port: int) -> tuple[str | None, bool]:
+    """Returns the address to use for the endpoint, None if it doesn't resolve,
+    and whether that address answered our probe"""
+    addresses = resolve_addresses(host, port)
+
+    winner = race_addresses(addresses)
+    if winner is not None:
+        return winner, True
+    fallback = (address for address in addresses if _routable(address, port))
+    return next(fallback, None), False
+
+
+def endpoint_address(host: str, port: int) -> str | None:
+    """pick_endpoint_address, caching addresses that answered"""
+    endpoint = f"{host}:{port}"
+    now = int(time.time())
+
+    cache = load_cache(cache_file(ENDPOINT_CACHE))
+    entry = cache.get(endpoint)
+    try:
+        if entry is not None and now - int(entry["resolved"]) < ENDPOINT_CACHE_TIMEOUT:
+            return str(entry["address"])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    address, confirmed = pick_endpoint_address(host, port)
+    if confirmed:
+        cache[endpoint] = dict(address=address, resolved=now)
+        save_cache(cache, cache_file(ENDPOINT_CACHE))
+    return address
+
+
+def pin_endpoints(config: WireguardConfig) -> WireguardConfig:
+    """Replace peer endpoint hostnames with the address we should use"""
+    peers = {}
+    for public_key, peer in config.peers.items():
+        host = peer.endpoint_host
+        if isinstance(host, str) and peer.endpoint_port is not None:
+            # bracketed IPv6 literals are not recognized by wireguard_tools
+            address = host.strip("[]")
+            try:
+                ip_address(address)
+            except ValueError:
+                address = endpoint_address(host, peer.endpoint_port) or host
+            peer = evolve(peer, endpoint_host=address)
+        peers[public_key] = peer
+    return evolve(config, peers=peers)
@@ -10,7 +10,6 @@
 
 from __future__ import annotations
 
-import os
 from pathlib import Path
 from uuid import UUID
 
@@ -19,6 +18,8 @@ from attrs import define
 from wireguard_tools import WireguardKey
 from xdg import xdg_cache_home
 
+from .yaml_cache import save_cache
+
 
 @define
 class KeyCacheEntry:
@@ -54,10 +55,7 @@ class KeyCacheEntry:
         return dict(public_key=str(self.public_key), private_key=str(self.private_key))
 
     def to_file(self, cache_file: Path) -> None:
-        cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
-        with cache_file.open("w") as fh:
-            os.fchmod(fh.fileno(), 0o600)
-            return yaml.dump(self.to_dict(), fh)
+        save_cache(self.to_dict(), cache_file)
 
     @classmethod
     def load(cls, application_uuid: UUID) -> KeyCacheEntry:
@@ -10,17 +10,33 @@
 
 from __future__ import annotations
 
+import os
+import select
 import subprocess
 import sys
+from contextlib import contextmanager
+from ipaddress import IPv4Network, IPv6Network
 from itertools import chain
 from pathlib import Path
 from shutil import which
 from tempfile import TemporaryDirectory
-from typing import Sequence
+from typing import Iterator, Sequence
 
-from wireguard4netns import create_wireguard_tunnel
+from attrs import define, evolve
 from wireguard_tools import WireguardConfig
 
+from .happy_eyeballs import pin_endpoints
+from .netns_helper import SLIRP_MTU, UPLINK, UPLINK_TIMEOUT
+from .path_mtu import endpoint_tunnel_mtu
+from .tunnel_backend import (
+    BACKENDS,
+    TUNNEL_ERRORS,
+    TunnelBackend,
+    backend_failed,
+    preferred_backends,
+    terminate_wireguard_go,
+)
+
 
 def unique_namespace_name(name: str) -> str:
     """Returns a name with only ascii lowercase letters.
@@ -33,29 +49,259 @@ def unique_namespace_name(name: str) -> str:
     return "".join(c for c in name.lower() if c.islower()) or "sinfonia"
 
 
-def sudo_create_wireguard_tunnel(
-    netns_pid: int, interface: str, config: WireguardConfig, tmpdir: Path
-) -> None:
-    """Try to bring up wireguard tunnel with sudo sinfonia_tier3.root_helper"""
-    sudo = which("sudo")
-    assert sudo is not None
+def tunnel_routes(config: WireguardConfig) -> list[IPv4Network | IPv6Network]:
+    """Networks that are routed through the tunnel in split-tunnel mode.
+
+    Returns an empty list when the tunnel wants a default route, it would
+    collide with the default route through the user-mode network.
+    """
+    routes: list[IPv4Network | IPv6Network] = []
+    for peer in config.peers.values():
+        for allowed_ip in peer.allowed_ips:
+            if allowed_ip.network.prefixlen == 0:
+                return []
+            if allowed_ip.network not in routes:
+                routes.append(allowed_ip.network)
+    return routes
+
+
+def user_mode_network_args(
+    netns_pid: int, interface: str, ready_fd: int
+) -> list[str] | None:
+    """Command to attach a slirp4netns user-mode network to the namespace,
+    it writes "1" to ready_fd once the interface is up"""
+    slirp4netns = which("slirp4netns")
+    if slirp4netns is None:
+        return None
+
+    return [
+        slirp4netns,
+        "--mtu",
+        str(SLIRP_MTU),
+        "--disable-host-loopback",
+        f"--ready-fd={ready_fd}",
+        str(netns_pid),
+        interface,
+    ]
+
+
+def user_mode_network_ready(ready_fd: int) -> bool:
+    """Wait for slirp4netns to signal it is ready, False when it exited or
+    timed out"""
+    ready, _, _ = select.select([ready_fd], [], [], UPLINK_TIMEOUT)
+    return bool(ready) and os.read(ready_fd, 1) == b"1"
+
+
+def start_user_mode_network(
+    netns_pid: int, interface: str
+) -> subprocess.Popen[bytes] | None:
+    """Attach a slirp4netns user-mode network to the namespace.
+
+    Returns once the uplink is ready, or None when it couldn't be attached.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            args = user_mode_network_args(netns_pid, interface, write_fd)
+            if args is None:
+                return None
+            uplink_proc = subprocess.Popen(args, pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+
+        if user_mode_network_ready(read_fd):
+            return uplink_proc
+    finally:
+        os.close(read_fd)
+
+    uplink_proc.kill()
+    uplink_proc.wait()
+    return None
+
+
+def dns_options(config: WireguardConfig, dns_cache: bool) -> tuple[str, list[str]]:
+    """Returns resolv.conf for the namespace and matching netns_helper args"""
+    if not dns_cache or not config.dns_servers:
+        return config.to_resolvconf(opt_ndots=5), []
+
+    # with the dns cache the application talks to the local forwarder
+    # which in turn forwards to the nameservers across the tunnel
+    resolv_config = evolve(config, dns_servers=["127.0.0.1"])
+    dns_cache_args = list(
+        chain.from_iterable(
+            ("--dns-cache", str(nameserver)) for nameserver in config.dns_servers
+        )
+    ) + list(
+        chain.from_iterable(("--search", domain) for domain in config.search_domains)
+    )
+    return resolv_config.to_resolvconf(opt_ndots=5), dns_cache_args
+
+
+@define
+class NamespaceLaunch:
+    args: list[str]
+    interface: str
+    uplink: bool
+    # tunnel configuration with the endpoint addresses we picked
+    config: WireguardConfig
+
+
+def namespace_launch(
+    tmpdir: Path,
+    deployment_name: str,
+    config: WireguardConfig,
+    application: Sequence[str],
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+) -> NamespaceLaunch:
+    """Prepare the command that starts application in a new network namespace
+    once the wireguard interface shows up.
+
+    This may resolve the endpoint and probe the path MTU to it, which can take
+    a moment.
+    """
+    # resolve a dual-stack endpoint now, instead of letting WireGuard use
+    # whichever address comes first
+    config = pin_endpoints(config)
+
+    resolv_conf_text, dns_cache_args = dns_options(config, dns_cache)
+    resolv_conf = tmpdir / "resolv.conf"
+    resolv_conf.write_text(resolv_conf_text)
+
+    unshare = which("unshare")
+    assert unshare is not None
+
+    NS = unique_namespace_name(deployment_name)
+    WG = f"wg-{NS}"[:15]
+
+    # size the tunnel interface to fit the path MTU to the endpoint
+    if mtu is None:
+        mtu = endpoint_tunnel_mtu(config)
+    mtu_args = ["--mtu", str(mtu)] if mtu is not None else []
+    if mss_clamp:
+        mtu_args.append("--mss-clamp")
 
-    wireguard_conf = tmpdir / "wg.conf"
-    wireguard_conf.write_text(config.to_wgconfig())
+    # only route the backend's networks through the tunnel, everything
+    # else goes through a user-mode network stack on the local host
+    split_tunnel_args: list[str] = []
+    if split_tunnel:
+        routes = tunnel_routes(config)
+        if which("slirp4netns") is None:
+            print("slirp4netns not found, routing all traffic through tunnel")
+        elif not routes:
+            print("tunnel allows all addresses, routing all traffic through tunnel")
+        else:
+            split_tunnel_args = list(
+                chain.from_iterable(("--route", str(route)) for route in routes)
+            ) + ["--uplink", UPLINK]
 
-    # create, configure and attach WireGuard interface
-    subprocess.run(
+    args = (
         [
-            sudo,
+            unshare,
+            "--user",
+            "--map-root-user",
+            "--net",
+            "--mount",
+            "--",
             sys.executable,
             "-m",
-            "sinfonia_tier3.root_helper",
-            str(netns_pid),
-            interface,
-            str(wireguard_conf.resolve()),
-        ],
-        check=True,
+            "sinfonia_tier3.netns_helper",
+            "--resolvconf",
+            str(resolv_conf.resolve()),
+        ]
+        + list(
+            chain.from_iterable(
+                ("--address", str(address)) for address in config.addresses
+            )
+        )
+        + dns_cache_args
+        + split_tunnel_args
+        + mtu_args
+        + [WG]
+        + list(application)
     )
+    return NamespaceLaunch(args, WG, bool(split_tunnel_args), config)
+
+
+def tunnel_backends(tunnel_backend: str | None = None) -> list[TunnelBackend]:
+    """Backends to try, fastest working for this host first unless one was
+    chosen"""
+    if tunnel_backend is not None:
+        return [BACKENDS[tunnel_backend]]
+    return preferred_backends()
+
+
+@contextmanager
+def tunnel_namespace(
+    tmpdir: Path,
+    deployment_name: str,
+    config: WireguardConfig,
+    application: Sequence[str],
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+) -> Iterator[subprocess.Popen[bytes]]:
+    """Start application in a new network namespace with a wireguard tunnel.
+
+    Leaving the context waits for the application to exit and then tears down
+    the tunnel.
+    """
+    launch = namespace_launch(
+        tmpdir,
+        deployment_name,
+        config,
+        application,
+        dns_cache=dns_cache,
+        split_tunnel=split_tunnel,
+        mtu=mtu,
+        mss_clamp=mss_clamp,
+    )
+    backends = tunnel_backends(tunnel_backend)
+    uplink_proc = None
+
+    # Running two processes pretty much in parallel here, the first one
+    # creates a new network namespace and then waits for the wireguard
+    # interface.
+    # The second process (wireguard-go or the sudo root helper) creates
+    # and configures the wireguard interface and attaches it to the new
+    # network namespace.
+    try:
+        with subprocess.Popen(launch.args) as netns_proc:
+            for backend in backends:
+                try:
+                    backend.create(
+                        netns_proc.pid, launch.interface, launch.config, tmpdir
+                    )
+                    break
+                except ValueError as exc:
+                    # the tunnel configuration, not the backend, is the problem
+                    print(f"Unable to create tunnel with {backend.description}: {exc}")
+                except TUNNEL_ERRORS:
+                    print(f"Failed to create tunnel with {backend.description}")
+                    backend_failed(backend.name)
+            else:
+                netns_proc.kill()
+                netns_proc.wait()
+
+            if netns_proc.returncode is None and launch.uplink:
+                uplink_proc = start_user_mode_network(netns_proc.pid, UPLINK)
+                if uplink_proc is None:
+                    print("Failed to attach user-mode network")
+                    netns_proc.kill()
+
+            yield netns_proc
+            # leaving the context will wait for the application to exit
+    finally:
+        # wireguard-go would otherwise keep the tun device and namespace alive
+        terminate_wireguard_go(tmpdir)
+
+        if uplink_proc is not None:
+            uplink_proc.terminate()
+            uplink_proc.wait()
 
 
 def sinfonia_runapp(
@@ -63,62 +309,31 @@ def sinfonia_runapp(
     config: WireguardConfig,
     application: Sequence[str],
     config_debug: bool = False,
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
 ) -> int:
     """Run application in an isolated network namespace with wireguard tunnel"""
+    if config_debug:
+        resolv_conf_text, _ = dns_options(config, dns_cache)
+        Path("resolv.conf").write_text(resolv_conf_text)
+        Path("wg.conf").write_text(config.to_wgconfig())
+        return 0
+
     with TemporaryDirectory() as temporary_directory:
-        if config_debug:
-            temporary_directory = "."
-        tmpdir = Path(temporary_directory)
-
-        resolv_conf = tmpdir / "resolv.conf"
-        resolv_conf.write_text(config.to_resolvconf(opt_ndots=5))
-
-        if config_debug:
-            wireguard_conf = tmpdir / "wg.conf"
-            wireguard_conf.write_text(config.to_wgconfig())
-            return 0
-
-        unshare = which("unshare")
-        assert unshare is not None
-
-        NS = unique_namespace_name(deployment_name)
-        WG = f"wg-{NS}"[:15]
-
-        # Running two processes pretty much in parallel here, the first one
-        # creates a new network namespace and then waits for the wireguard
-        # interface.
-        # The second process runs as root and creates and configures the
-        # wireguard interface and attaches it to the new network namespace.
-        with subprocess.Popen(
-            [
-                unshare,
-                "--user",
-                "--map-root-user",
-                "--net",
-                "--mount",
-                "--",
-                sys.executable,
-                "-m",
-                "sinfonia_tier3.netns_helper",
-                "--resolvconf",
-                str(resolv_conf.resolve()),
-            ]
-            + list(
-                chain.from_iterable(
-                    ("--address", str(address)) for address in config.addresses
-                )
-            )
-            + [WG]
-            + list(application)
+        with tunnel_namespace(
+            Path(temporary_directory),
+            deployment_name,
+            config,
+            application,
+            dns_cache=dns_cache,
+            split_tunnel=split_tunnel,
+            mtu=mtu,
+            mss_clamp=mss_clamp,
+            tunnel_backend=tunnel_backend,
         ) as netns_proc:
-            try:
-                create_wireguard_tunnel(netns_proc.pid, WG, config, tmpdir)
-            except (AssertionError, FileNotFoundError, subprocess.CalledProcessError):
-                print("Failed to run wireguard-go, falling back to sudo root helper")
-                try:
-                    sudo_create_wireguard_tunnel(netns_proc.pid, WG, config, tmpdir)
-                except (AssertionError, subprocess.CalledProcessError):
-                    print("Failed to run sudo root helper")
-                    netns_proc.kill()
-            # leaving the context will wait for the application to exit
-    return 0
+            pass
+    # leaving the context waited for the application to exit
+    return netns_proc.returncode
@@ -14,13 +14,31 @@ import argparse
 import os
 import subprocess
 import sys
-from ipaddress import IPv4Interface, IPv6Interface, ip_interface
+from ipaddress import (
+    IPv4Interface,
+    IPv4Network,
+    IPv6Interface,
+    IPv6Network,
+    ip_address,
+    ip_interface,
+    ip_network,
+)
 from pathlib import Path
 from shutil import which
 
 from pyroute2 import NDB
 
 from . import __version__
+from .dns_cache import fork_dns_cache
+
+# user-mode network interface and the addresses slirp4netns uses for it
+UPLINK = "tap0"
+SLIRP_ADDRESS = "10.0.2.100/24"
+SLIRP_GATEWAY = "10.0.2.2"
+SLIRP_MTU = 65520
+
+# how long we wait for slirp4netns to attach the uplink
+UPLINK_TIMEOUT = 10
 
 #
 # Things we do in the network namespace
@@ -28,9 +46,13 @@ from . import __version__
 # - Bind mount /etc/resolv.conf
 # - Bring up the loopback interface.
 # - Wait for wireguard interface to appear in our namespace.
-# - Bring the wireguard interface up.
+# - Set the MTU and bring the wireguard interface up.
 # - Configure ip addresses on the wireguard interface.
-# - Add default route through the wireguard interface.
+# - Add default route through the wireguard interface, or in split-tunnel
+#   mode only routes for the tunnel's allowed ips and a default route through
+#   the user-mode network (slirp4netns) interface.
+# - Optionally clamp the TCP MSS to the path MTU.
+# - Optionally start a caching DNS forwarder on 127.0.0.1.
 # - Launch application.
 #
 
@@ -44,13 +66,21 @@ def bind_mount(resolvconf: Path) -> None:
 
 
 def configure_network(
-    interface: str, addresses: list[IPv4Interface | IPv6Interface]
+    interface: str,
+    addresses: list[IPv4Interface | IPv6Interface],
+    routes: list[IPv4Network | IPv6Network] | None = None,
+    uplink: str | None = None,
+    mtu: int | None = None,
 ) -> None:
     with NDB() as ndb:
         with ndb.interfaces["lo"] as loopback:
             loopback.set(state="up")
 
         with ndb.interfaces.wait(ifname=interface) as wg:
+            # ip link set <interface> mtu <mtu>
+            if mtu is not None:
+                wg.set(mtu=mtu)
+
             # ip link set <interface> up
             wg.set(state="up")
 
@@ -59,8 +89,62 @@ def configure_network(
                 wg.add_ip(str(address))
 
         with ndb.interfaces[interface] as wg:
-            # ip route add default dev <interface>
-            ndb.routes.create(dst="default", oif=wg["index"]).commit()
+            if not routes:
+                # ip route add default dev <interface>
+                ndb.routes.create(dst="default", oif=wg["index"]).commit()
+            else:
+                # ip route add <network> dev <interface>
+                for route in routes:
+                    ndb.routes.create(dst=str(route), oif=wg["index"]).commit()
+
+        if uplink is not None:
+            configure_uplink(ndb, uplink)
+
+
+def configure_uplink(ndb: NDB, uplink: str) -> None:
+    """Configure the user-mode network interface created by slirp4netns.
+
+    raises TimeoutError when the interface doesn't show up.
+    """
+    with ndb.interfaces.wait(ifname=uplink, timeout=UPLINK_TIMEOUT) as tap:
+        # ip link set <uplink> mtu <mtu> up
+        tap.set(state="up")
+        tap.set(mtu=SLIRP_MTU)
+
+        # ip addr add 10.0.2.100/24 dev <uplink>
+        tap.add_ip(SLIRP_ADDRESS)
+
+    # ip route add default via 10.0.2.2
+    ndb.routes.create(dst="default", gateway=SLIRP_GATEWAY).commit()
+
+
+def clamp_mss(interface: str) -> None:
+    """Clamp the TCP MSS of connections through the tunnel to the path MTU"""
+    for command in ("iptables", "ip6tables"):
+        iptables = which(command)
+        if iptables is None:
+            print(f"{command} not found, not clamping MSS")
+            continue
+        subprocess.run(
+            [
+                iptables,
+                "-t",
+                "mangle",
+                "-A",
+                "POSTROUTING",
+                "-o",
+                interface,
+                "-p",
+                "tcp",
+                "--tcp-flags",
+                "SYN,RST",
+                "SYN",
+                "-j",
+                "TCPMSS",
+                "--clamp-mss-to-pmtu",
+            ],
+            check=False,
+        )
 
 
 def main() -> int:
@@ -77,6 +161,39 @@ def main() -> int:
         type=ip_interface,
         action="append",
     )
+    parser.add_argument(
+        "--mtu",
+        type=int,
+        help="MTU of the wireguard interface",
+    )
+    parser.add_argument(
+        "--mss-clamp",
+        action="store_true",
+        help="Clamp TCP MSS to the path MTU on the wireguard interface",
+    )
+    parser.add_argument(
+        "--route",
+        type=lambda value: ip_network(value, strict=False),
+        action="append",
+        help="Only route this network through the tunnel (split-tunnel)",
+    )
+    parser.add_argument(
+        "--uplink",
+        help="User-mode network interface to use for the default route",
+    )
+    parser.add_argument(
+        "--dns-cache",
+        metavar="NAMESERVER",
+        type=ip_address,
+        action="append",
+        help="Run caching DNS forwarder on 127.0.0.1 for these nameservers",
+    )
+    parser.add_argument(
+        "--search",
+        action="append",
+        default=[],
+        help="Search domain handled by the caching DNS forwarder",
+    )
     parser.add_argument(
         "interface",
     )
@@ -89,7 +206,19 @@ def main() -> int:
     if args.resolvconf is not None:
         bind_mount(args.resolvconf)
 
-    configure_network(args.interface, args.address)
+    try:
+        configure_network(
+            args.interface, args.address, args.route, args.uplink, args.mtu
+        )
+    except TimeoutError:
+        print(f"{args.uplink} did not show up, is slirp4netns running?")
+        return 1
+
+    if args.mss_clamp:
+        clamp_mss(args.interface)
+
+    if args.dns_cache is not None:
+        fork_dns_cache(args.dns_cache, args.search)
 
     # Run application
     env = os.environ.copy()
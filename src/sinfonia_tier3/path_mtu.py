@@ -0,0 +1,201 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Path MTU discovery towards the cloudlet's WireGuard endpoint.
+
+The MTU of the tunnel interface has to leave room for the WireGuard overhead
+on the path to the endpoint, otherwise large packets get fragmented or, when
+ICMP is filtered, silently dropped. We probe with ICMP echo requests that have
+the don't-fragment bit set. When the endpoint doesn't answer pings or we are
+not allowed to send them, we leave the backend's default MTU alone.
+"""
+
+from __future__ import annotations
+
+import socket
+import struct
+import time
+from ipaddress import IPv6Address, ip_address
+from typing import Callable
+
+from wireguard_tools import WireguardConfig
+
+from .yaml_cache import cache_file, load_cache, save_cache
+
+# linux socket options, not all of these are exported by the socket module
+IP_MTU_DISCOVER = 10
+IP_MTU = 14
+IP_PMTUDISC_PROBE = 3
+IPV6_MTU_DISCOVER = 23
+IPV6_MTU = 24
+IPV6_PMTUDISC_PROBE = 3
+
+ICMP_ECHO_REQUEST = 8
+ICMPV6_ECHO_REQUEST = 128
+
+# we don't bother with jumbo frames, the minimum is what IPv6 guarantees
+MAX_PATH_MTU = 1500
+MIN_PATH_MTU = 1280
+
+# outer IP header + UDP header + WireGuard data message header and tag
+WIREGUARD_OVERHEAD_IPV4 = 20 + 8 + 32
+WIREGUARD_OVERHEAD_IPV6 = 40 + 8 + 32
+
+# an echo reply can get lost without the packet being too large
+PROBE_ATTEMPTS = 3
+
+MTU_CACHE = "path_mtu.yaml"
+MTU_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _route_mtu(family: socket.AddressFamily, address: str, port: int) -> int:
+    """Ask the kernel what it thinks the path MTU is for a destination"""
+    level, option = (
+        (socket.IPPROTO_IPV6, IPV6_MTU)
+        if family == socket.AF_INET6
+        else (socket.IPPROTO_IP, IP_MTU)
+    )
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.connect((address, port))
+        return int(sock.getsockopt(level, option))
+
+
+def _ping(sock: socket.socket, echo_type: int, size: int, timeout: float) -> bool:
+    """Send a single unfragmented echo request of size bytes (icmp header
+    included), returns True if we got a reply."""
+    sequence = int(time.monotonic() * 1000) & 0xFFFF
+    payload = bytes(size - 8)
+    sock.send(struct.pack("!BBHHH", echo_type, 0, 0, 0, sequence) + payload)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        sock.settimeout(remaining)
+        try:
+            reply = sock.recv(65535)
+        except socket.timeout:
+            return False
+        if len(reply) >= 8 and struct.unpack_from("!H", reply, 6)[0] == sequence:
+            return True
+
+
+def search_path_mtu(ping: Callable[[int], bool], upper: int) -> int | None:
+    """Binary search for the largest packet size that gets an answer, None
+    when not even the smallest packet did."""
+
+    def fits(mtu: int) -> bool:
+        return any(ping(mtu) for _ in range(PROBE_ATTEMPTS))
+
+    if fits(upper):
+        return upper
+    if not fits(MIN_PATH_MTU):
+        return None
+
+    lower = MIN_PATH_MTU
+    while upper - lower > 8:
+        middle = (lower + upper) // 2
+        if fits(middle):
+            lower = middle
+        else:
+            upper = middle
+    return lower
+
+
+def probe_path_mtu(address: str, port: int, timeout: float = 0.5) -> int | None:
+    """Find the largest packet that reaches address without being fragmented.
+
+    Returns None when we can't tell, because we are not allowed to send pings
+    or the endpoint doesn't answer them. The kernel's idea of the path MTU is
+    only an upper bound and often wrong when ICMP is filtered.
+
+    raises OSError when there is no route to the address.
+    """
+    ipv6 = isinstance(ip_address(address), IPv6Address)
+    family = socket.AF_INET6 if ipv6 else socket.AF_INET
+    upper = min(_route_mtu(family, address, port), MAX_PATH_MTU)
+
+    if ipv6:
+        proto, echo_type, header = socket.IPPROTO_ICMPV6, ICMPV6_ECHO_REQUEST, 40
+        level, option, value = (
+            socket.IPPROTO_IPV6,
+            IPV6_MTU_DISCOVER,
+            IPV6_PMTUDISC_PROBE,
+        )
+    else:
+        proto, echo_type, header = socket.IPPROTO_ICMP, ICMP_ECHO_REQUEST, 20
+        level, option, value = socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE
+
+    try:
+        sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+    except OSError:
+        # unprivileged ping sockets not allowed (net.ipv4.ping_group_range)
+        return None
+
+    with sock:
+        sock.setsockopt(level, option, value)
+        sock.connect((address, 0))
+
+        def ping(mtu: int) -> bool:
+            try:
+                return _ping(sock, echo_type, mtu - header, timeout)
+            except OSError:
+                # EMSGSIZE, the kernel already knows this is too large
+                return False
+
+        return search_path_mtu(ping, upper)
+
+
+def tunnel_mtu(path_mtu: int, ipv6: bool = False) -> int:
+    """MTU for the WireGuard interface given the path MTU to the endpoint"""
+    overhead = WIREGUARD_OVERHEAD_IPV6 if ipv6 else WIREGUARD_OVERHEAD_IPV4
+    return path_mtu - overhead
+
+
+def endpoint_tunnel_mtu(config: WireguardConfig) -> int | None:
+    """Return the tunnel MTU for the (first) peer endpoint in the config.
+
+    Probed path MTUs are cached per endpoint in ~/.cache/sinfonia/path_mtu.yaml
+    """
+    for peer in config.peers.values():
+        if peer.endpoint_host is not None and peer.endpoint_port is not None:
+            host, port = str(peer.endpoint_host), peer.endpoint_port
+            break
+    else:
+        return None
+
+    endpoint = f"{host}:{port}"
+    now = int(time.time())
+
+    cache = load_cache(cache_file(MTU_CACHE))
+    entry = cache.get(endpoint)
+    try:
+        if entry is not None and now - entry["probed"] < MTU_CACHE_TIMEOUT:
+            return int(entry["mtu"])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    try:
+        sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0][4]
+        address = str(sockaddr[0])
+        path_mtu = probe_path_mtu(address, port)
+    except OSError:
+        return None
+
+    if path_mtu is None:
+        # keep the backend's default, and try again next time
+        return None
+
+    ipv6 = isinstance(ip_address(address), IPv6Address)
+    mtu = tunnel_mtu(path_mtu, ipv6)
+
+    cache[endpoint] = dict(mtu=mtu, probed=now)
+    save_cache(cache, cache_file(MTU_CACHE))
+    return mtu
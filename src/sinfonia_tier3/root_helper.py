@@ -27,6 +27,7 @@ from . import __version__
 # - Create wireguard interface in the primary (routed) namespace.
 # - Set wireguard tunnel/peer configuration.
 # - Attach wireguard interface to network namespace.
+# - Remove stale wireguard interfaces left behind by earlier runs.
 #
 
 
@@ -58,21 +59,48 @@ def create_config_attach(interface: str, config: WireguardConfig, netns: str) ->
             ipr.link("set", index=iface["index"], net_ns_fd=net_ns_fd)
 
 
+def delete_interface(interface: str) -> None:
+    with IPRoute() as ipr:
+        (iface,) = ipr.link("get", ifname=interface)
+
+        # refuse to touch anything we could not have created
+        linkinfo = iface.get_attr("IFLA_LINKINFO")
+        kind = linkinfo.get_attr("IFLA_INFO_KIND") if linkinfo else None
+        if not interface.startswith("wg-") or kind != "wireguard":
+            raise ValueError(f"{interface} is not a sinfonia wireguard interface")
+
+        # ip link del <interface>
+        ipr.link("del", index=iface["index"])
+
+
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--version", action="version", version=f"%(prog)s {__version__}"
     )
-    parser.add_argument("netns")
-    parser.add_argument("interface")
+    parser.add_argument(
+        "--delete",
+        metavar="INTERFACE",
+        help="Remove a stale wireguard interface",
+    )
+    parser.add_argument("netns", nargs="?")
+    parser.add_argument("interface", nargs="?")
     parser.add_argument(
         "wgconfig",
         metavar="wireguard.conf",
+        nargs="?",
         type=argparse.FileType("r"),
         default=sys.stdin,
     )
     args = parser.parse_args()
 
+    if args.delete is not None:
+        delete_interface(args.delete)
+        return 0
+
+    if args.netns is None or args.interface is None:
+        parser.error("netns and interface are required")
+
     wgconfig = WireguardConfig.from_wgconfig(args.wgconfig)
 
     create_config_attach(args.interface, wgconfig, args.netns)
@@ -0,0 +1,234 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Run Python code inside the application's network namespace.
+
+Instead of launching a separate frontend application we keep a placeholder
+process ('sleep infinity') in the network namespace, and fork workers from
+the calling process that join the namespaces of the placeholder with setns.
+The workers inherit the in-memory state of the caller, and all of their
+network traffic goes through the WireGuard tunnel to the backend.
+
+    with sinfonia_session(tier1_url, application_uuid) as session:
+        status = session.run(requests.get, "http://helloworld/").status_code
+        with session.pool(4) as pool:
+            results = pool.map(fetch, urls)
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import subprocess
+import time
+from contextlib import contextmanager, suppress
+from multiprocessing.connection import Connection
+from multiprocessing.pool import Pool
+from pathlib import Path
+from shutil import which
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Iterator, TypeVar
+from uuid import UUID
+
+from attrs import define
+from requests.exceptions import RequestException
+from wireguard_tools import WireguardConfig
+from yarl import URL
+
+from .cloudlet_deployment import sinfonia_deploy, sinfonia_release
+from .local_deployment import tunnel_namespace
+
+SESSION_TIMEOUT = 30
+
+# the user namespace has to be joined first, it grants the capabilities
+# needed to join the others
+NAMESPACES = ["user", "mnt", "net"]
+
+T = TypeVar("T")
+
+
+def _setns(path: str) -> None:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.setns(fd, 0) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+
+
+def join_namespace(pid: int) -> None:
+    """Move the current (single threaded) process into the namespaces of pid"""
+    cwd = os.getcwd()
+    for namespace in NAMESPACES:
+        _setns(f"/proc/{pid}/ns/{namespace}")
+
+    # joining a mount namespace resets the working directory
+    with suppress(OSError):
+        os.chdir(cwd)
+
+
+def _run_in_namespace(
+    pid: int,
+    conn: Connection,
+    func: Callable[..., Any],
+    args: tuple[Any, ...],
+    kwargs: dict[str, Any],
+) -> None:
+    try:
+        join_namespace(pid)
+        result: tuple[bool, Any] = (True, func(*args, **kwargs))
+    except Exception as exc:
+        result = (False, exc)
+
+    try:
+        conn.send(result)
+    except Exception as exc:
+        # result or exception could not be pickled
+        conn.send((False, RuntimeError(f"Unable to return result: {exc!r}")))
+    finally:
+        conn.close()
+
+
+@define
+class TunnelSession:
+    deployment_name: str
+    pid: int
+
+    def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call func in a forked worker inside the network namespace.
+
+        Returns the result or re-raises the exception raised by func.
+        """
+        ctx = multiprocessing.get_context("fork")
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        worker = ctx.Process(
+            target=_run_in_namespace,
+            args=(self.pid, child_conn, func, args, kwargs),
+        )
+        worker.start()
+        child_conn.close()
+        try:
+            success, result = parent_conn.recv()
+        except EOFError:
+            raise RuntimeError(
+                f"Worker exited without a result (exitcode {worker.exitcode})"
+            ) from None
+        finally:
+            parent_conn.close()
+            worker.join()
+
+        if not success:
+            raise result
+        return result  # type: ignore[no-any-return]
+
+    def pool(self, processes: int | None = None) -> Pool:
+        """Pool of forked workers that run inside the network namespace.
+
+        Raises the error from join_namespace when the namespace can not be
+        joined, the pool would otherwise keep respawning failing workers.
+        """
+        # the placeholder may be gone, check with a single worker first
+        self.run(os.getpid)
+
+        ctx = multiprocessing.get_context("fork")
+        return ctx.Pool(processes, initializer=join_namespace, initargs=(self.pid,))
+
+
+def _wait_for_namespace(proc: subprocess.Popen[bytes]) -> None:
+    """netns_helper replaces itself with the placeholder once the network
+    namespace is configured."""
+    cmdline = Path("/proc", str(proc.pid), "cmdline")
+    deadline = time.monotonic() + SESSION_TIMEOUT
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError("Failed to set up network namespace")
+        with suppress(OSError):
+            if b"sinfonia_tier3.netns_helper" not in cmdline.read_bytes():
+                return
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out setting up network namespace")
+        time.sleep(0.05)
+
+
+@contextmanager
+def open_session(
+    deployment_name: str,
+    config: WireguardConfig,
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+) -> Iterator[TunnelSession]:
+    """Bring up a network namespace with wireguard tunnel for the duration
+    of the context"""
+    sleep = which("sleep")
+    assert sleep is not None
+
+    with TemporaryDirectory() as temporary_directory:
+        with tunnel_namespace(
+            Path(temporary_directory),
+            deployment_name,
+            config,
+            [sleep, "infinity"],
+            dns_cache=dns_cache,
+            split_tunnel=split_tunnel,
+            mtu=mtu,
+            mss_clamp=mss_clamp,
+            tunnel_backend=tunnel_backend,
+        ) as placeholder:
+            try:
+                _wait_for_namespace(placeholder)
+                yield TunnelSession(deployment_name, placeholder.pid)
+            finally:
+                placeholder.terminate()
+
+
+@contextmanager
+def sinfonia_session(
+    tier1_url: URL | str,
+    application_uuid: UUID,
+    debug: bool = False,
+    zeroconf: bool = False,
+    dns_cache: bool = False,
+    split_tunnel: bool = False,
+    mtu: int | None = None,
+    mss_clamp: bool = False,
+    tunnel_backend: str | None = None,
+    release: bool = True,
+) -> Iterator[TunnelSession]:
+    """Deploy a backend and run Python code connected to it.
+
+    Raises the requests exceptions when the deployment fails.
+    """
+    deployments = sinfonia_deploy(URL(tier1_url), application_uuid, debug, zeroconf)
+
+    # Pick the best deployment (first returned for now...)
+    deployment_data = deployments[0]
+
+    try:
+        with open_session(
+            deployment_data.deployment_name,
+            deployment_data.tunnel_config,
+            dns_cache=dns_cache,
+            split_tunnel=split_tunnel,
+            mtu=mtu,
+            mss_clamp=mss_clamp,
+            tunnel_backend=tunnel_backend,
+        ) as session:
+            yield session
+    finally:
+        # tier2 will still clean up once it notices the tunnel is idle
+        if release:
+            with suppress(RequestException):
+                sinfonia_release(URL(tier1_url), application_uuid, debug)
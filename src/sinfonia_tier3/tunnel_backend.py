@@ -0,0 +1,436 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2021-2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""Ways to create the WireGuard tunnel into the application's network namespace.
+
+- userspace: wireguard-go with a tun device created through wireguard4netns,
+  does not need any privileges.
+- kernel: in-kernel WireGuard configured by the root_helper through sudo.
+
+Which one is fastest depends on the host, so we benchmark the available
+backends once and remember the preferred order per host in
+~/.cache/sinfonia/tunnel_backends.yaml.
+"""
+
+from __future__ import annotations
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from ipaddress import IPv6Address
+from pathlib import Path
+from shutil import which
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Sequence
+
+import importlib_resources
+from attrs import define, evolve, field
+from wireguard4netns import create_wireguard_tunnel
+from wireguard_tools import WireguardConfig, WireguardKey
+
+from .yaml_cache import cache_file, load_cache, save_cache
+
+BACKEND_CACHE = "tunnel_backends.yaml"
+BENCHMARK_TIMEOUT = 30 * 24 * 60 * 60
+BENCHMARK_SIZE = 16 * 1024 * 1024
+FAILURE_TIMEOUT = 24 * 60 * 60
+
+# exceptions we expect when a backend cannot create a tunnel on this host,
+# backends raise ValueError when they can't handle the tunnel configuration
+TUNNEL_ERRORS = (
+    AssertionError,
+    FileNotFoundError,
+    OSError,
+    RuntimeError,
+    subprocess.CalledProcessError,
+)
+
+
+def sudo_create_wireguard_tunnel(
+    netns_pid: int, interface: str, config: WireguardConfig, tmpdir: Path
+) -> None:
+    """Try to bring up wireguard tunnel with sudo sinfonia_tier3.root_helper"""
+    sudo = which("sudo")
+    assert sudo is not None
+
+    wireguard_conf = tmpdir / "wg.conf"
+    wireguard_conf.write_text(config.to_wgconfig())
+
+    # create, configure and attach WireGuard interface
+    subprocess.run(
+        [
+            sudo,
+            sys.executable,
+            "-m",
+            "sinfonia_tier3.root_helper",
+            str(netns_pid),
+            interface,
+            str(wireguard_conf.resolve()),
+        ],
+        check=True,
+    )
+
+
+class _BracketedIPv6Address(IPv6Address):
+    """IPv6 endpoint address that formats as [address].
+
+    WireguardUAPIDevice.set_config writes endpoints as address:port, but
+    wireguard-go only accepts IPv6 endpoints with brackets.
+    """
+
+    def __str__(self) -> str:
+        return f"[{super().__str__()}]"
+
+
+def userspace_create_wireguard_tunnel(
+    netns_pid: int, interface: str, config: WireguardConfig, tmpdir: Path
+) -> None:
+    """Bring up wireguard tunnel with wireguard-go through wireguard4netns"""
+    peers = {}
+    for public_key, peer in config.peers.items():
+        if isinstance(peer.endpoint_host, str):
+            raise ValueError(f"Endpoint {peer.endpoint_host} did not resolve")
+        if isinstance(peer.endpoint_host, IPv6Address):
+            peer = evolve(
+                peer, endpoint_host=_BracketedIPv6Address(str(peer.endpoint_host))
+            )
+        peers[public_key] = peer
+
+    create_wireguard_tunnel(netns_pid, interface, evolve(config, peers=peers), tmpdir)
+
+
+def _userspace_available() -> bool:
+    wireguard_go = importlib_resources.files("wireguard4netns").joinpath("wireguard-go")
+    return wireguard_go.is_file() and Path("/dev/net/tun").exists()
+
+
+def _kernel_available() -> bool:
+    # only when sudo doesn't need a password, we don't want to prompt the user
+    # just to run a benchmark
+    sudo = which("sudo")
+    if sudo is None:
+        return False
+    result = subprocess.run(
+        [sudo, "-n", "true"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+
+@define
+class TunnelBackend:
+    name: str
+    description: str
+    create: Callable[[int, str, WireguardConfig, Path], None]
+    available: Callable[[], bool]
+
+
+# in the order we try them when we know nothing about the host
+BACKENDS = {
+    backend.name: backend
+    for backend in [
+        TunnelBackend(
+            "userspace",
+            "wireguard-go",
+            userspace_create_wireguard_tunnel,
+            _userspace_available,
+        ),
+        TunnelBackend(
+            "kernel",
+            "in-kernel WireGuard through sudo root helper",
+            sudo_create_wireguard_tunnel,
+            _kernel_available,
+        ),
+    ]
+}
+
+
+#
+# Remember which backend works best on this host
+#
+@define
+class BackendResult:
+    setup_time: float | None = None
+    throughput: float | None = None
+
+    @property
+    def working(self) -> bool:
+        return self.throughput is not None
+
+
+@define
+class BackendPreference:
+    measured: float = 0.0
+    results: dict[str, BackendResult] = field(factory=dict)
+    # when backends last failed to create a tunnel outside of the benchmark
+    failed: dict[str, float] = field(factory=dict)
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self.measured > BENCHMARK_TIMEOUT
+
+    def order(self) -> list[TunnelBackend]:
+        """Fastest working backend first, untested next and broken ones last"""
+
+        def sort_key(backend: TunnelBackend) -> tuple[int, float]:
+            result = self.results.get(backend.name)
+            if time.time() - self.failed.get(backend.name, 0.0) < FAILURE_TIMEOUT:
+                return (2, 0.0)
+            if result is None:
+                return (1, 0.0)
+            if not result.working:
+                return (2, 0.0)
+            return (0, -(result.throughput or 0.0))
+
+        return sorted(BACKENDS.values(), key=sort_key)
+
+    def mark_broken(self, name: str) -> None:
+        """Try the backend last for a while, afterwards the benchmark result
+        counts again"""
+        self.failed[name] = time.time()
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> BackendPreference:
+        # raises ValueError when input is incorrectly formatted
+        try:
+            results = {
+                name: BackendResult(**result)
+                for name, result in data.get("results", {}).items()
+            }
+            failed = {
+                str(name): float(timestamp)
+                for name, timestamp in data.get("failed", {}).items()
+            }
+            return cls(float(data["measured"]), results, failed)
+        except (AttributeError, TypeError, KeyError, ValueError) as exc:
+            raise ValueError("Unexpected preference format") from exc
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(
+            measured=self.measured,
+            results={
+                name: dict(setup_time=result.setup_time, throughput=result.throughput)
+                for name, result in self.results.items()
+            },
+            failed=dict(self.failed),
+        )
+
+    @classmethod
+    def load(cls) -> BackendPreference | None:
+        """Return the stored preference for this host if we have one"""
+        hosts = load_cache(cache_file(BACKEND_CACHE))
+        try:
+            return cls.from_dict(hosts[socket.gethostname()])
+        except (KeyError, ValueError):
+            return None
+
+    def save(self) -> None:
+        hosts = load_cache(cache_file(BACKEND_CACHE))
+        hosts[socket.gethostname()] = self.to_dict()
+        save_cache(hosts, cache_file(BACKEND_CACHE))
+
+
+#
+# Loopback benchmark
+#
+# sends size bytes to host:port and prints the throughput in MB/s
+THROUGHPUT_CLIENT = """
+import socket, sys, time
+host, port, size = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+deadline = time.monotonic() + 10
+while True:
+    try:
+        sock = socket.create_connection((host, port), timeout=10)
+        break
+    except OSError:
+        if time.monotonic() > deadline:
+            raise
+        time.sleep(0.1)
+buf = bytes(65536)
+start = time.monotonic()
+for _ in range(size // len(buf)):
+    sock.sendall(buf)
+sock.shutdown(socket.SHUT_WR)
+assert sock.recv(2) == b"ok"
+print(size / (time.monotonic() - start) / 1e6)
+"""
+
+# receives a single transfer on host:port
+THROUGHPUT_SINK = """
+import socket, sys
+srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind((sys.argv[1], int(sys.argv[2])))
+srv.listen()
+conn, _ = srv.accept()
+while conn.recv(65536):
+    pass
+conn.sendall(b"ok")
+"""
+
+
+def spawn_namespace(
+    interface: str, address: str, helper_args: Sequence[str], script: Sequence[str]
+) -> subprocess.Popen[str]:
+    """Run a python script in a new network namespace through netns_helper"""
+    unshare = which("unshare")
+    assert unshare is not None
+    return subprocess.Popen(
+        [
+            unshare,
+            "--user",
+            "--map-root-user",
+            "--net",
+            "--",
+            sys.executable,
+            "-m",
+            "sinfonia_tier3.netns_helper",
+            "--address",
+            address,
+            *helper_args,
+            interface,
+            sys.executable,
+            "-c",
+            *script,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+
+
+def terminate_wireguard_go(tmpdir: Path) -> None:
+    """wireguard-go keeps running as long as it holds the tun device open,
+    find the instances that were started in tmpdir and stop them."""
+    for proc in Path("/proc").glob("[0-9]*"):
+        try:
+            if (proc / "cwd").resolve() != tmpdir.resolve():
+                continue
+            pid = int(proc.name)
+            os.kill(pid, signal.SIGTERM)
+            # reap it when it was started by us
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def _free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def loopback_tunnel_configs(
+    host: str = "127.0.0.1",
+) -> tuple[WireguardConfig, WireguardConfig]:
+    """Client and peer configs for a tunnel between two local namespaces"""
+    client_key, peer_key = WireguardKey.generate(), WireguardKey.generate()
+    client_port, peer_port = _free_udp_port(), _free_udp_port()
+
+    client_config = WireguardConfig.from_dict(
+        dict(
+            private_key=client_key,
+            listen_port=client_port,
+            peers=[
+                dict(
+                    public_key=peer_key.public_key(),
+                    endpoint=f"{host}:{peer_port}",
+                    allowed_ips=["10.0.0.0/24"],
+                    persistent_keepalive=1,
+                )
+            ],
+        )
+    )
+    peer_config = WireguardConfig.from_dict(
+        dict(
+            private_key=peer_key,
+            listen_port=peer_port,
+            peers=[
+                dict(
+                    public_key=client_key.public_key(),
+                    endpoint=f"{host}:{client_port}",
+                    allowed_ips=["10.0.0.2/32"],
+                )
+            ],
+        )
+    )
+    return client_config, peer_config
+
+
+def benchmark_backend(
+    backend: TunnelBackend, size: int = BENCHMARK_SIZE, host: str = "127.0.0.1"
+) -> BackendResult:
+    """Measure tunnel setup time and throughput over the loopback interface.
+
+    Returns a result without throughput when the backend doesn't work.
+    """
+    client_config, peer_config = loopback_tunnel_configs(host)
+
+    with TemporaryDirectory() as temporary_directory:
+        tmpdir = Path(temporary_directory)
+        peer = spawn_namespace(
+            "wg-peer", "10.0.0.1/24", [], [THROUGHPUT_SINK, "10.0.0.1", "5201"]
+        )
+        client = spawn_namespace(
+            "wg-client",
+            "10.0.0.2/32",
+            [],
+            [THROUGHPUT_CLIENT, "10.0.0.1", "5201", str(size)],
+        )
+        try:
+            backend.create(peer.pid, "wg-peer", peer_config, tmpdir)
+
+            start = time.monotonic()
+            backend.create(client.pid, "wg-client", client_config, tmpdir)
+            setup_time = time.monotonic() - start
+
+            output, _ = client.communicate(timeout=60)
+            if client.returncode != 0:
+                return BackendResult(setup_time)
+            return BackendResult(setup_time, float(output))
+        except (*TUNNEL_ERRORS, subprocess.TimeoutExpired, ValueError):
+            return BackendResult()
+        finally:
+            for proc in (client, peer):
+                proc.kill()
+                proc.wait()
+            terminate_wireguard_go(tmpdir)
+
+
+def benchmark_backends() -> BackendPreference:
+    preference = BackendPreference(time.time())
+    for backend in BACKENDS.values():
+        if backend.available():
+            preference.results[backend.name] = benchmark_backend(backend)
+    return preference
+
+
+def preferred_backends(benchmark: bool = True) -> list[TunnelBackend]:
+    """Backends in the order they should be tried on this host"""
+    preference = BackendPreference.load()
+    if preference is None or preference.stale:
+        if not benchmark or which("unshare") is None:
+            return (preference or BackendPreference()).order()
+
+        print("Benchmarking WireGuard backends... ", end="", flush=True)
+        preference = benchmark_backends()
+        preference.save()
+        print("done")
+    return preference.order()
+
+
+def backend_failed(name: str) -> None:
+    """Remember a backend failed so that we don't try it first next time"""
+    # without a stored preference this is not a benchmark, leave measured
+    # unset so that we still run one
+    preference = BackendPreference.load() or BackendPreference()
+    preference.mark_broken(name)
+    preference.save()
@@ -0,0 +1,40 @@
+#
+# Sinfonia
+#
+# deploy helm charts to a cloudlet kubernetes cluster for edge-native applications
+#
+# Copyright (c) 2023 Carnegie Mellon University
+#
+# SPDX-License-Identifier: MIT
+#
+"""YAML files in ~/.cache/sinfonia that remember what we learned about this
+host and the networks it is on. They are only readable by the user."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Any
+
+import yaml
+from xdg import xdg_cache_home
+
+
+def cache_file(name: str) -> Path:
+    return xdg_cache_home() / "sinfonia" / name
+
+
+def load_cache(path: Path) -> dict[str, Any]:
+    """Return the cached mapping, empty when missing or unreadable"""
+    try:
+        cache = yaml.safe_load(path.read_text())
+    except (FileNotFoundError, yaml.YAMLError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(cache: dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    with path.open("w") as fh:
+        os.fchmod(fh.fileno(), 0o600)
+        yaml.dump(cache, fh)
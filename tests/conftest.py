@@ -1,7 +1,46 @@
 # Copyright (c) 2022 Carnegie Mellon University
 # SPDX-License-Identifier: MIT
 
+from __future__ import annotations
+
+import subprocess
+import sys
+from pathlib import Path
+from shutil import which
+from typing import Sequence
+
 import pytest
+from wireguard_tools import WireguardConfig, WireguardKey
+
+
+def can_unshare_with_tun() -> bool:
+    """Can we create network namespaces and tun devices for tunnel tests"""
+    if which("unshare") is None or not Path("/dev/net/tun").exists():
+        return False
+    check = "import os; os.open('/dev/net/tun', os.O_RDWR)"
+    result = subprocess.run(
+        ["unshare", "--user", "--map-root-user", "--net", sys.executable, "-c", check],
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def make_config(
+    endpoint: str = "127.0.0.1:51820", allowed_ips: Sequence[str] = ("10.0.0.0/24",)
+) -> WireguardConfig:
+    """Tunnel configuration with a single peer and fresh keys"""
+    return WireguardConfig.from_dict(
+        dict(
+            private_key=WireguardKey.generate(),
+            peers=[
+                dict(
+                    public_key=WireguardKey.generate().public_key(),
+                    endpoint=endpoint,
+                    allowed_ips=list(allowed_ips),
+                )
+            ],
+        )
+    )
 
 
 @pytest.fixture(scope="session")
@@ -1,12 +1,20 @@
 # Copyright (c) 2022 Carnegie Mellon University
 # SPDX-License-Identifier: MIT
 
+from pathlib import Path
+from types import SimpleNamespace
 from uuid import UUID
 
 import pytest
+import requests
+import requests_mock
+from _pytest.monkeypatch import MonkeyPatch
 from yarl import URL
 
+from sinfonia_tier3 import cli
 from sinfonia_tier3.cli import parse_args
+from sinfonia_tier3.cloudlet_deployment import sinfonia_release
+from sinfonia_tier3.key_cache import KeyCacheEntry
 
 pytestmark = pytest.mark.filterwarnings(
     "ignore:.*Validator.iter_errors.*:DeprecationWarning"
@@ -44,6 +52,52 @@ def test_parser() -> None:
     assert args.application == ["true"]
 
 
+def test_release(
+    monkeypatch: MonkeyPatch, tmp_path: Path, requests_mock: requests_mock.Mocker
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    keys = KeyCacheEntry.load(UUID(NULL_UUID))
+
+    # mock the tier1/tier2 server
+    release_url = (
+        f"http://localhost:8080/api/v1/deploy/{NULL_UUID}/{keys.public_key.urlsafe}"
+    )
+    requests_mock.delete(release_url, status_code=204)
+    sinfonia_release(URL("http://localhost:8080"), UUID(NULL_UUID))
+    assert requests_mock.call_count == 1
+    assert requests_mock.last_request is not None
+    assert requests_mock.last_request.method == "DELETE"
+
+    requests_mock.delete(release_url, status_code=404)
+    with pytest.raises(requests.HTTPError):
+        sinfonia_release(URL("http://localhost:8080"), UUID(NULL_UUID))
+
+
+def test_release_on_exit(monkeypatch: MonkeyPatch) -> None:
+    """the deployment is released whichever way the application exits"""
+    deployment = SimpleNamespace(deployment_name="testing-test", tunnel_config=None)
+    released: list[UUID] = []
+    interrupt = False
+
+    def fake_runapp(*args: object, **kwargs: object) -> int:
+        if interrupt:
+            raise KeyboardInterrupt
+        return 3
+
+    monkeypatch.setattr(cli, "sinfonia_deploy", lambda *args: [deployment])
+    monkeypatch.setattr(cli, "sinfonia_runapp", fake_runapp)
+    monkeypatch.setattr(
+        cli, "sinfonia_release", lambda url, uuid, debug: released.append(uuid)
+    )
+
+    assert cli.sinfonia_tier3("http://localhost:8080", UUID(NULL_UUID), ["app"]) == 3
+
+    interrupt = True
+    with pytest.raises(KeyboardInterrupt):
+        cli.sinfonia_tier3("http://localhost:8080", UUID(NULL_UUID), ["app"])
+    assert released == [UUID(NULL_UUID), UUID(NULL_UUID)]
+
+
 # # switch back to Click so we can benefit from the better test harness?
 #
 # from pathlib import Path
@@ -0,0 +1,211 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import asyncio
+import signal
+import sys
+import time
+from ipaddress import ip_interface
+from pathlib import Path
+from shutil import which
+from tempfile import TemporaryDirectory
+from uuid import UUID
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from attrs import evolve
+from wireguard4netns import create_wireguard_tunnel
+from yarl import URL
+
+from sinfonia_tier3.tunnel_backend import (
+    THROUGHPUT_CLIENT,
+    THROUGHPUT_SINK,
+    TunnelBackend,
+    loopback_tunnel_configs,
+    spawn_namespace,
+    terminate_wireguard_go,
+)
+
+from .conftest import can_unshare_with_tun
+from .test_app import NULL_UUID, SUCCESSFUL_DEPLOYMENT
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from sinfonia_tier3 import async_deployment  # noqa: E402
+from sinfonia_tier3.async_deployment import (  # noqa: E402
+    _teardown,
+    async_sinfonia_deploy,
+    async_sinfonia_release,
+    async_sinfonia_runapp,
+    async_sinfonia_tier3,
+)
+
+pytestmark = pytest.mark.filterwarnings(
+    "ignore:.*Validator.iter_errors.*:DeprecationWarning"
+)
+
+SINK_PORT = 5201
+
+
+def test_deploy_release(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    requests: list[str] = []
+
+    async def deploy(request: web.Request) -> web.Response:
+        requests.append(request.method)
+        return web.json_response(SUCCESSFUL_DEPLOYMENT)
+
+    async def release(request: web.Request) -> web.Response:
+        requests.append(request.method)
+        return web.Response(status=404, text="no such deployment")
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_post("/api/v1/deploy/{uuid}/{key}", deploy)
+        app.router.add_delete("/api/v1/deploy/{uuid}/{key}", release)
+
+        async with TestServer(app) as server:
+            tier1_url = URL(str(server.make_url("/")))
+            deployments = await async_sinfonia_deploy(tier1_url, UUID(NULL_UUID))
+            assert deployments[0].deployment_name == "testing-test"
+            assert [
+                str(address) for address in deployments[0].tunnel_config.addresses
+            ] == ["10.0.0.2/32"]
+
+            with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+                await async_sinfonia_release(tier1_url, UUID(NULL_UUID))
+            assert excinfo.value.message == "no such deployment"
+
+    asyncio.run(run())
+    assert requests == ["POST", "DELETE"]
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+def test_failed_launch(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """when no backend works we raise and release with the caller's session"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    requests: list[tuple[str, str | None]] = []
+
+    def broken_backend(pid: int, interface: str, config: object, tmpdir: Path) -> None:
+        raise RuntimeError("broken")
+
+    backend = TunnelBackend("broken", "broken backend", broken_backend, lambda: True)
+    monkeypatch.setattr(async_deployment, "tunnel_backends", lambda name: [backend])
+    monkeypatch.setattr(async_deployment, "backend_failed", lambda name: None)
+
+    async def handler(request: web.Request) -> web.Response:
+        requests.append((request.method, request.headers.get("X-Session")))
+        if request.method == "POST":
+            return web.json_response(SUCCESSFUL_DEPLOYMENT)
+        return web.Response(status=204)
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_post("/api/v1/deploy/{uuid}/{key}", handler)
+        app.router.add_delete("/api/v1/deploy/{uuid}/{key}", handler)
+
+        async with TestServer(app) as server:
+            async with aiohttp.ClientSession(headers={"X-Session": "1"}) as session:
+                with pytest.raises(RuntimeError):
+                    await async_sinfonia_tier3(
+                        str(server.make_url("/")),
+                        UUID(NULL_UUID),
+                        ["true"],
+                        mtu=1420,
+                        session=session,
+                    )
+
+    asyncio.run(run())
+    assert requests == [("POST", "1"), ("DELETE", "1")]
+
+
+IGNORE_SIGTERM = """
+import signal, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print("ready", flush=True)
+time.sleep(60)
+"""
+
+
+def test_teardown_kills(monkeypatch: MonkeyPatch) -> None:
+    """don't wait forever on an application that ignores SIGTERM"""
+    monkeypatch.setattr(async_deployment, "TEARDOWN_TIMEOUT", 0.5)
+    tmpdir = TemporaryDirectory()
+
+    async def run() -> int | None:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", IGNORE_SIGTERM, stdout=asyncio.subprocess.PIPE
+        )
+        assert proc.stdout is not None
+        await proc.stdout.readline()
+        await _teardown(proc, None, tmpdir)
+        return proc.returncode
+
+    start = time.monotonic()
+    assert asyncio.run(run()) == -signal.SIGKILL
+    assert time.monotonic() - start < 10
+    assert not Path(tmpdir.name).exists()
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+def test_launch_lifecycle(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """run concurrent launches through a loopback tunnel, one to completion
+    and the others cancelled"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    client_config, peer_config = loopback_tunnel_configs()
+    client_config = evolve(client_config, addresses=[ip_interface("10.0.0.2/32")])
+
+    peer = spawn_namespace(
+        "wg-peer", "10.0.0.1/24", [], [THROUGHPUT_SINK, "10.0.0.1", str(SINK_PORT)]
+    )
+
+    sleep = which("sleep")
+    assert sleep is not None
+
+    async def run() -> None:
+        transfer = await async_sinfonia_runapp(
+            "transfer",
+            client_config,
+            [sys.executable, "-c", THROUGHPUT_CLIENT, "10.0.0.1", str(SINK_PORT)]
+            + [str(1024 * 1024)],
+            mtu=1420,
+            tunnel_backend="userspace",
+        )
+        idle = [
+            await async_sinfonia_runapp(
+                f"idle{index}",
+                # tunnels to a peer that doesn't exist
+                evolve(loopback_tunnel_configs()[0], addresses=client_config.addresses),
+                [sleep, "infinity"],
+                mtu=1420,
+                tunnel_backend="userspace",
+            )
+            for index in range(2)
+        ]
+
+        assert await transfer == 0
+        assert transfer.returncode == 0
+
+        assert not any(launch.done() for launch in idle)
+        for launch in idle:
+            launch.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await launch
+            assert launch.returncode is None
+
+    try:
+        create_wireguard_tunnel(peer.pid, "wg-peer", peer_config, tmp_path)
+        asyncio.run(run())
+    finally:
+        peer.kill()
+        peer.wait()
+        terminate_wireguard_go(tmp_path)
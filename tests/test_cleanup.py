@@ -0,0 +1,90 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from uuid import UUID
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from wireguard4netns import create_wireguard_tunnel
+from wireguard_tools import WireguardConfig, WireguardKey
+
+from sinfonia_tier3.cleanup import stale_config_files, stale_processes
+from sinfonia_tier3.key_cache import KeyCacheEntry
+from sinfonia_tier3.tunnel_backend import loopback_tunnel_configs, spawn_namespace
+
+from .conftest import can_unshare_with_tun
+
+
+def test_config_debug_files(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    keys = KeyCacheEntry.load(UUID("00000000-0000-0000-0000-000000000000"))
+
+    config = WireguardConfig.from_dict(
+        dict(private_key=keys.private_key, dns=["10.0.0.1"])
+    )
+    (tmp_path / "wg.conf").write_text(config.to_wgconfig())
+    (tmp_path / "resolv.conf").write_text(config.to_resolvconf(opt_ndots=5))
+
+    stale = stale_config_files(tmp_path)
+    assert len(stale) == 2
+    for resource in stale:
+        resource.remove()
+    assert not (tmp_path / "wg.conf").exists()
+    assert not (tmp_path / "resolv.conf").exists()
+
+
+def test_foreign_config_files(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """leave wireguard configs that are not ours alone"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    KeyCacheEntry.load(UUID("00000000-0000-0000-0000-000000000000"))
+
+    config = WireguardConfig(private_key=WireguardKey.generate())
+    (tmp_path / "wg.conf").write_text(config.to_wgconfig())
+    assert stale_config_files(tmp_path) == []
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+def test_orphaned_wireguard_go() -> None:
+    _, peer_config = loopback_tunnel_configs()
+    netns = spawn_namespace("wg-orphan", "10.0.0.1/24", [], ["pass"])
+
+    with TemporaryDirectory() as tmpdir:
+        create_wireguard_tunnel(netns.pid, "wg-orphan", peer_config, Path(tmpdir))
+        netns.wait()
+        assert not [r for r in stale_processes() if "wg-orphan" in r.description]
+
+    # the temporary directory is gone, as if sinfonia_runapp crashed
+    (orphan,) = [r for r in stale_processes() if "wg-orphan" in r.description]
+    orphan.remove()
+
+    time.sleep(0.5)
+    assert not [r for r in stale_processes() if "wg-orphan" in r.description]
+
+
+def test_foreign_wireguard_go(tmp_path: Path) -> None:
+    """leave wireguard-go instances that wireguard4netns didn't start alone"""
+    workdir = tmp_path / "foreign"
+    workdir.mkdir()
+    (workdir / "wg-foreign").write_text("import time; time.sleep(60)")
+    proc = subprocess.Popen(
+        [str(workdir / "wireguard-go"), "wg-foreign"],
+        executable=sys.executable,
+        cwd=workdir,
+    )
+    try:
+        time.sleep(0.5)
+        shutil.rmtree(workdir)
+        assert not [r for r in stale_processes() if "wg-foreign" in r.description]
+    finally:
+        proc.kill()
+        proc.wait()
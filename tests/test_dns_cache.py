@@ -0,0 +1,161 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import struct
+import threading
+import time
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from sinfonia_tier3 import dns_cache
+from sinfonia_tier3.dns_cache import (
+    RCODE_NOERROR,
+    RCODE_NXDOMAIN,
+    TYPE_A,
+    TYPE_CNAME,
+    TYPE_SOA,
+    DnsCache,
+    DnsMessage,
+    ResourceRecord,
+    cache_ttl,
+    encode_name,
+    make_query,
+    make_response,
+)
+
+SEARCH = ["default.svc.cluster.local", "svc.cluster.local", "cluster.local"]
+
+
+def a_record(name: str, ttl: int = 30) -> ResourceRecord:
+    return ResourceRecord(name, TYPE_A, 1, ttl, bytes([10, 0, 0, 42]))
+
+
+def soa_record(ttl: int = 60, minimum: int = 5) -> ResourceRecord:
+    rdata = (
+        encode_name("ns.cluster.local")
+        + encode_name("hostmaster.cluster.local")
+        + struct.pack("!IIIII", 1, 7200, 1800, 86400, minimum)
+    )
+    return ResourceRecord("cluster.local", TYPE_SOA, 1, ttl, rdata)
+
+
+class FakeUpstream:
+    def __init__(self, records: dict[str, int], slow: str | None = None) -> None:
+        self.records = records
+        self.queries: list[str] = []
+        # queries for the slow name block until released
+        self.slow = slow
+        self.release = threading.Event()
+
+    def __call__(self, query: bytes) -> bytes:
+        request = DnsMessage.parse(query)
+        assert request.question is not None
+        qname = request.question[0]
+        self.queries.append(qname)
+        if qname == self.slow:
+            self.release.wait(10)
+        if qname in self.records:
+            return make_response(
+                request, RCODE_NOERROR, [a_record(qname, self.records[qname])]
+            )
+        response = make_response(request, RCODE_NXDOMAIN)
+        # append SOA to the authority section
+        header = bytearray(response[:12])
+        header[9] = 1
+        return bytes(header) + response[12:] + soa_record().to_wire()
+
+
+def test_parse_roundtrip() -> None:
+    query = DnsMessage.parse(make_query("helloworld.cluster.local", TYPE_A))
+    response = DnsMessage.parse(
+        make_response(query, RCODE_NOERROR, [a_record("helloworld.cluster.local")])
+    )
+    assert response.ident == query.ident
+    assert response.question == ("helloworld.cluster.local", TYPE_A, 1)
+    assert response.answers[0].rdata == bytes([10, 0, 0, 42])
+    assert cache_ttl(response) == 30
+
+
+def test_positive_and_negative_caching(monkeypatch: MonkeyPatch) -> None:
+    upstream = FakeUpstream({"helloworld": 30})
+    cache = DnsCache(["10.0.0.1"])
+    monkeypatch.setattr(cache, "forward", upstream)
+
+    for _ in range(3):
+        response = DnsMessage.parse(cache.resolve(make_query("helloworld", TYPE_A)))
+        assert response.rcode == RCODE_NOERROR
+        missing = DnsMessage.parse(cache.resolve(make_query("missing", TYPE_A)))
+        assert missing.rcode == RCODE_NXDOMAIN
+    assert upstream.queries == ["helloworld", "missing"]
+
+
+def test_search_collapse(monkeypatch: MonkeyPatch) -> None:
+    upstream = FakeUpstream({"helloworld.svc.cluster.local": 30})
+    cache = DnsCache(["10.0.0.1"], SEARCH)
+    monkeypatch.setattr(cache, "forward", upstream)
+
+    query = make_query("helloworld.default.svc.cluster.local", TYPE_A)
+    response = DnsMessage.parse(cache.resolve(query))
+    assert response.ident == DnsMessage.parse(query).ident
+    assert response.rcode == RCODE_NOERROR
+    assert response.answers[0].rtype == TYPE_CNAME
+    assert response.answers[0].target == "helloworld.svc.cluster.local"
+    assert response.answers[1].rtype == TYPE_A
+
+    # the remaining candidates finish in the background
+    deadline = time.monotonic() + 5
+    while len(cache._cache) < len(SEARCH) + 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(upstream.queries) == len(SEARCH) + 1
+
+    # all candidates are now cached
+    cache.resolve(query)
+    assert len(upstream.queries) == len(SEARCH) + 1
+
+
+def test_search_does_not_wait_for_later_candidates(monkeypatch: MonkeyPatch) -> None:
+    upstream = FakeUpstream({"helloworld.default.svc.cluster.local": 30}, "helloworld")
+    cache = DnsCache(["10.0.0.1"], SEARCH)
+    monkeypatch.setattr(cache, "forward", upstream)
+
+    start = time.monotonic()
+    query = make_query("helloworld.default.svc.cluster.local", TYPE_A)
+    response = DnsMessage.parse(cache.resolve(query))
+    assert time.monotonic() - start < 5
+    assert response.answers[0].rtype == TYPE_A
+    upstream.release.set()
+
+
+def test_ttl_countdown(monkeypatch: MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(dns_cache.time, "monotonic", lambda: now)
+
+    upstream = FakeUpstream({"helloworld": 30})
+    cache = DnsCache(["10.0.0.1"])
+    monkeypatch.setattr(cache, "forward", upstream)
+
+    response = DnsMessage.parse(cache.resolve(make_query("helloworld", TYPE_A)))
+    assert response.answers[0].ttl == 30
+
+    now += 12
+    response = DnsMessage.parse(cache.resolve(make_query("helloworld", TYPE_A)))
+    assert response.answers[0].ttl == 18
+    assert upstream.queries == ["helloworld"]
+
+    now += 20
+    cache.resolve(make_query("helloworld", TYPE_A))
+    assert upstream.queries == ["helloworld", "helloworld"]
+
+
+def test_cache_size(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(dns_cache, "MAX_CACHE_ENTRIES", 4)
+
+    upstream = FakeUpstream({f"host{index}": 30 for index in range(10)})
+    cache = DnsCache(["10.0.0.1"])
+    monkeypatch.setattr(cache, "forward", upstream)
+
+    for index in range(10):
+        cache.resolve(make_query(f"host{index}", TYPE_A))
+    assert len(cache._cache) == 4
@@ -0,0 +1,120 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import socket
+import threading
+from ipaddress import IPv4Address, IPv6Address
+from pathlib import Path
+from typing import Any
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from sinfonia_tier3 import happy_eyeballs
+from sinfonia_tier3.happy_eyeballs import (
+    pin_endpoints,
+    race_addresses,
+    resolve_addresses,
+)
+
+from .conftest import make_config
+
+
+def test_resolve_interleaved(monkeypatch: MonkeyPatch) -> None:
+    addresses = {
+        socket.AF_INET6: ["fd00::1", "fd00::2", "fd00::3"],
+        socket.AF_INET: ["192.0.2.1"],
+    }
+
+    def fake_getaddrinfo(
+        host: str, port: int, family: socket.AddressFamily, *args: Any
+    ) -> list[tuple[Any, ...]]:
+        return [(family, 0, 0, "", (address, port)) for address in addresses[family]]
+
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo)
+    assert resolve_addresses("cloudlet.example", 51820) == [
+        "fd00::1",
+        "192.0.2.1",
+        "fd00::2",
+        "fd00::3",
+    ]
+
+
+def _udp_responder(host: str) -> tuple[socket.socket, int]:
+    """UDP socket standing in for a host that answers our probes"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((host, 0))
+
+    def respond() -> None:
+        while True:
+            try:
+                data, address = sock.recvfrom(1024)
+                sock.sendto(data, address)
+            except OSError:
+                return
+
+    threading.Thread(target=respond, daemon=True).start()
+    return sock, int(sock.getsockname()[1])
+
+
+def test_race(monkeypatch: MonkeyPatch) -> None:
+    """the first address that answers wins, later ones get their turn when
+    earlier ones stay quiet or fail"""
+    responder, port = _udp_responder("127.0.0.1")
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind(("127.0.0.3", 0))
+    ports = {"127.0.0.1": port, "127.0.0.3": silent.getsockname()[1]}
+
+    def udp_probe(address: str) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        # nothing listens on 127.0.0.2, we'll get connection refused
+        sock.connect((address, ports.get(address, port)))
+        sock.send(b"probe")
+        return sock
+
+    monkeypatch.setattr(happy_eyeballs, "_probe_socket", udp_probe)
+    try:
+        assert race_addresses(["127.0.0.1", "127.0.0.3"]) == "127.0.0.1"
+        assert race_addresses(["127.0.0.3", "127.0.0.1"], delay=0.05) == ("127.0.0.1")
+        assert race_addresses(["127.0.0.2", "127.0.0.1"], delay=10) == ("127.0.0.1")
+        assert race_addresses(["127.0.0.3"], timeout=0.1) is None
+    finally:
+        responder.close()
+        silent.close()
+
+
+def test_pin_endpoints(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """test that hostnames are replaced and addresses that answered are
+    cached"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    picks: list[str] = []
+
+    def fake_pick(host: str, port: int) -> tuple[str, bool]:
+        picks.append(host)
+        return ("fd00::1", True) if host == "cloudlet.example" else ("fd00::3", False)
+
+    monkeypatch.setattr(happy_eyeballs, "pick_endpoint_address", fake_pick)
+
+    for _ in range(2):
+        config = pin_endpoints(make_config("cloudlet.example:51820"))
+        peer = next(iter(config.peers.values()))
+        assert peer.endpoint_host == IPv6Address("fd00::1")
+        assert peer.endpoint_port == 51820
+    assert picks == ["cloudlet.example"]
+
+    config = pin_endpoints(make_config("[fd00::2]:51820"))
+    assert next(iter(config.peers.values())).endpoint_host == IPv6Address("fd00::2")
+
+    config = pin_endpoints(make_config("192.0.2.1:51820"))
+    assert next(iter(config.peers.values())).endpoint_host == IPv4Address("192.0.2.1")
+    assert picks == ["cloudlet.example"]
+
+    # a fallback that didn't answer the race is not cached
+    for _ in range(2):
+        config = pin_endpoints(make_config("flaky.example:51820"))
+        assert next(iter(config.peers.values())).endpoint_host == IPv6Address("fd00::3")
+    assert picks == ["cloudlet.example", "flaky.example", "flaky.example"]
@@ -0,0 +1,94 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+from pathlib import Path
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from sinfonia_tier3 import path_mtu
+from sinfonia_tier3.path_mtu import (
+    MAX_PATH_MTU,
+    MIN_PATH_MTU,
+    endpoint_tunnel_mtu,
+    probe_path_mtu,
+    search_path_mtu,
+    tunnel_mtu,
+)
+from sinfonia_tier3.yaml_cache import load_cache
+
+from .conftest import make_config
+
+
+def test_tunnel_mtu() -> None:
+    # the default wireguard MTU assumes an IPv6 path with a 1500 byte MTU
+    assert tunnel_mtu(1500, ipv6=True) == 1420
+    assert tunnel_mtu(1500) == 1440
+    assert tunnel_mtu(1492) == 1432  # PPPoE
+
+
+def test_probe_loopback() -> None:
+    # None when we are not allowed to send pings
+    mtu = probe_path_mtu("127.0.0.1", 51820)
+    assert mtu is None or MIN_PATH_MTU <= mtu <= MAX_PATH_MTU
+
+
+def test_search_lossy_path() -> None:
+    """a lost echo reply shouldn't count as the packet being too large"""
+    attempts = iter(range(1000))
+
+    def lossy_ping(mtu: int) -> bool:
+        # PPPoE path that drops every other reply
+        return mtu <= 1492 and next(attempts) % 2 == 1
+
+    mtu = search_path_mtu(lossy_ping, MAX_PATH_MTU)
+    assert mtu is not None and 1492 - 8 <= mtu <= 1492
+
+    # no answers at all, we don't know anything
+    assert search_path_mtu(lambda mtu: False, MAX_PATH_MTU) is None
+
+
+def test_cached_mtu(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """test that probed MTUs are reused for the same endpoint"""
+    cache_dir = Path(tmp_path, "cache").resolve()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_dir))
+
+    probes: list[str] = []
+
+    def fake_probe(address: str, port: int) -> int:
+        probes.append(address)
+        return 1492
+
+    monkeypatch.setattr(path_mtu, "probe_path_mtu", fake_probe)
+
+    config = make_config("127.0.0.1:51820")
+    assert endpoint_tunnel_mtu(config) == 1432
+    assert endpoint_tunnel_mtu(config) == 1432
+    assert probes == ["127.0.0.1"]
+
+    assert endpoint_tunnel_mtu(make_config("127.0.0.2:51820")) == 1432
+    assert probes == ["127.0.0.1", "127.0.0.2"]
+
+    cache = load_cache(cache_dir / "sinfonia" / "path_mtu.yaml")
+    assert cache["127.0.0.1:51820"]["mtu"] == 1432
+
+
+def test_unknown_mtu(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """when probing fails we keep the default MTU and don't cache that"""
+    cache_dir = Path(tmp_path, "cache").resolve()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_dir))
+
+    probes: list[str] = []
+
+    def fake_probe(address: str, port: int) -> int | None:
+        probes.append(address)
+        return None
+
+    monkeypatch.setattr(path_mtu, "probe_path_mtu", fake_probe)
+
+    config = make_config("127.0.0.1:51820")
+    assert endpoint_tunnel_mtu(config) is None
+    assert endpoint_tunnel_mtu(config) is None
+    assert probes == ["127.0.0.1", "127.0.0.1"]
+    assert load_cache(cache_dir / "sinfonia" / "path_mtu.yaml") == {}
@@ -0,0 +1,104 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import os
+import socket
+import subprocess
+import time
+from ipaddress import ip_interface
+from pathlib import Path
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from attrs import evolve
+from wireguard4netns import create_wireguard_tunnel
+
+from sinfonia_tier3.session import TunnelSession, open_session
+from sinfonia_tier3.tunnel_backend import (
+    THROUGHPUT_SINK,
+    loopback_tunnel_configs,
+    spawn_namespace,
+    terminate_wireguard_go,
+)
+
+from .conftest import can_unshare_with_tun
+
+SINK_PORT = 5201
+STATE = {"answer": 0}
+
+
+def _netns() -> str:
+    return os.readlink("/proc/self/ns/net")
+
+
+def _send(size: int) -> bytes:
+    # the sink may still be starting up in the peer namespace
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            sock = socket.create_connection(("10.0.0.1", SINK_PORT), timeout=10)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    with sock:
+        sock.sendall(bytes(size))
+        sock.shutdown(socket.SHUT_WR)
+        return sock.recv(2)
+
+
+def _square(value: int) -> tuple[int, str]:
+    return value * value, _netns()
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+def test_session(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    client_config, peer_config = loopback_tunnel_configs()
+    client_config = evolve(client_config, addresses=[ip_interface("10.0.0.2/32")])
+
+    peer = spawn_namespace(
+        "wg-peer", "10.0.0.1/24", [], [THROUGHPUT_SINK, "10.0.0.1", str(SINK_PORT)]
+    )
+    try:
+        create_wireguard_tunnel(peer.pid, "wg-peer", peer_config, tmp_path)
+
+        with open_session(
+            "test", client_config, mtu=1420, tunnel_backend="userspace"
+        ) as session:
+            netns = session.run(_netns)
+            assert netns != _netns()
+
+            # forked workers see the caller's state
+            STATE["answer"] = 42
+            assert session.run(lambda: STATE["answer"]) == 42
+
+            with pytest.raises(ZeroDivisionError):
+                session.run(lambda: 1 // 0)
+
+            assert session.run(_send, 1024 * 1024) == b"ok"
+
+            with session.pool(2) as pool:
+                results = pool.map(_square, range(4))
+            assert [value for value, _ in results] == [0, 1, 4, 9]
+            assert all(worker_netns == netns for _, worker_netns in results)
+    finally:
+        peer.kill()
+        peer.wait()
+        terminate_wireguard_go(tmp_path)
+
+
+def test_pool_without_namespace() -> None:
+    """don't hang in pool.map when the placeholder is gone"""
+    placeholder = subprocess.Popen(["true"])
+    placeholder.wait()
+
+    session = TunnelSession("test", placeholder.pid)
+    with pytest.raises(OSError):
+        session.pool(2)
@@ -0,0 +1,168 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import os
+import socket
+import sys
+import threading
+from ipaddress import ip_network
+from pathlib import Path
+from shutil import which
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from wireguard4netns import create_wireguard_tunnel
+
+from sinfonia_tier3 import local_deployment
+from sinfonia_tier3.local_deployment import start_user_mode_network, tunnel_routes
+from sinfonia_tier3.netns_helper import UPLINK
+from sinfonia_tier3.tunnel_backend import (
+    THROUGHPUT_CLIENT,
+    THROUGHPUT_SINK,
+    loopback_tunnel_configs,
+    spawn_namespace,
+    terminate_wireguard_go,
+)
+
+from .conftest import can_unshare_with_tun, make_config
+
+TRANSFER_SIZE = 32 * 1024 * 1024
+SINK_PORT = 5201
+
+# also report how much traffic went out through the tunnel interface
+TUNNEL_CLIENT = THROUGHPUT_CLIENT + """
+for line in open("/proc/net/dev"):
+    name, _, stats = line.partition(":")
+    if name.strip() == "wg-client":
+        print(stats.split()[8])
+"""
+
+
+def _host_address() -> str | None:
+    """Non-loopback address of the host, slirp4netns is started with
+    --disable-host-loopback so the namespace can't reach 127.0.0.1"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            # no packets are sent, this only picks the source address
+            sock.connect(("192.0.2.1", 9))
+        except OSError:
+            return None
+        address = str(sock.getsockname()[0])
+    return None if address.startswith("127.") else address
+
+
+def _sink(server: socket.socket) -> None:
+    conn, _ = server.accept()
+    with conn:
+        while conn.recv(65536):
+            pass
+        conn.sendall(b"ok")
+
+
+def test_tunnel_routes() -> None:
+    config = make_config(allowed_ips=["10.0.0.1/24", "10.0.0.0/24", "fd00::1/64"])
+    assert tunnel_routes(config) == [
+        ip_network("10.0.0.0/24"),
+        ip_network("fd00::/64"),
+    ]
+
+    # a default route would conflict with the uplink, fall back to full tunnel
+    assert tunnel_routes(make_config(allowed_ips=["10.0.0.0/24", "0.0.0.0/0"])) == []
+    assert tunnel_routes(make_config(allowed_ips=["::/0"])) == []
+
+
+FAKE_SLIRP4NETNS = f"""#!{sys.executable}
+# --mtu 65520 --disable-host-loopback --ready-fd=N pid interface
+import os, sys, time
+if os.environ.get("READY"):
+    os.write(int(sys.argv[4].split("=")[1]), b"1")
+time.sleep(60)
+"""
+
+
+def test_start_user_mode_network(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """only return the uplink once slirp4netns signalled it is ready"""
+    fake = tmp_path / "slirp4netns"
+    fake.write_text(FAKE_SLIRP4NETNS)
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setattr(local_deployment, "UPLINK_TIMEOUT", 0.5)
+
+    assert start_user_mode_network(os.getpid(), UPLINK) is None
+
+    monkeypatch.setenv("READY", "1")
+    uplink = start_user_mode_network(os.getpid(), UPLINK)
+    assert uplink is not None
+    assert uplink.poll() is None
+    uplink.kill()
+    uplink.wait()
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+@pytest.mark.parametrize("mode", ["full", "split"])
+def test_loopback_throughput(mode: str, tmp_path: Path) -> None:
+    """Compare the tunnel and the split-tunnel uplink.
+
+    In full mode the client reaches a sink behind a second wireguard-go
+    instance (standing in for the cloudlet) over the loopback interface, in
+    split mode it reaches a sink on the host through slirp4netns and the
+    data should bypass the tunnel.
+    """
+    server = None
+    if mode == "full":
+        target, extra = "10.0.0.1", []
+    else:
+        host_address = _host_address()
+        if which("slirp4netns") is None or host_address is None:
+            pytest.skip("requires slirp4netns and a non-loopback host address")
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host_address, SINK_PORT))
+        server.listen()
+        threading.Thread(target=_sink, args=(server,), daemon=True).start()
+        target, extra = host_address, ["--route", "10.0.0.0/24", "--uplink", UPLINK]
+
+    client_config, peer_config = loopback_tunnel_configs()
+
+    peer = spawn_namespace(
+        "wg-peer", "10.0.0.1/24", [], [THROUGHPUT_SINK, "10.0.0.1", str(SINK_PORT)]
+    )
+    client = spawn_namespace(
+        "wg-client",
+        "10.0.0.2/32",
+        extra,
+        [TUNNEL_CLIENT, target, str(SINK_PORT), str(TRANSFER_SIZE)],
+    )
+    uplink = None
+    try:
+        create_wireguard_tunnel(peer.pid, "wg-peer", peer_config, tmp_path)
+        create_wireguard_tunnel(client.pid, "wg-client", client_config, tmp_path)
+
+        if mode == "split":
+            uplink = start_user_mode_network(client.pid, UPLINK)
+            assert uplink is not None
+
+        output, _ = client.communicate(timeout=60)
+        assert client.returncode == 0
+    finally:
+        for proc in (client, peer, uplink):
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+        if server is not None:
+            server.close()
+        terminate_wireguard_go(tmp_path)
+
+    throughput, tunnel_bytes = output.split()
+    print(f"{mode}: {float(throughput):.1f} MB/s")
+    assert float(throughput) > 0
+
+    if mode == "full":
+        assert int(tunnel_bytes) >= TRANSFER_SIZE
+    else:
+        assert int(tunnel_bytes) < TRANSFER_SIZE // 100
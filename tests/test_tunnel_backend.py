@@ -0,0 +1,142 @@
+# Copyright (c) 2023 Carnegie Mellon University
+# SPDX-License-Identifier: MIT
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from wireguard_tools import WireguardConfig
+
+from sinfonia_tier3 import tunnel_backend
+from sinfonia_tier3.tunnel_backend import (
+    BACKENDS,
+    FAILURE_TIMEOUT,
+    BackendPreference,
+    BackendResult,
+    backend_failed,
+    benchmark_backend,
+    preferred_backends,
+    userspace_create_wireguard_tunnel,
+)
+
+from .conftest import can_unshare_with_tun, make_config
+
+
+def test_backend_order() -> None:
+    preference = BackendPreference(
+        time.time(),
+        {
+            "userspace": BackendResult(0.2, 100.0),
+            "kernel": BackendResult(0.5, 900.0),
+        },
+    )
+    assert [backend.name for backend in preference.order()] == ["kernel", "userspace"]
+
+    preference.mark_broken("kernel")
+    assert [backend.name for backend in preference.order()] == ["userspace", "kernel"]
+
+    preference = BackendPreference.from_dict(preference.to_dict())
+    assert [backend.name for backend in preference.order()] == ["userspace", "kernel"]
+
+    # failures expire, after that the benchmark result counts again
+    preference.failed["kernel"] -= FAILURE_TIMEOUT
+    assert [backend.name for backend in preference.order()] == ["kernel", "userspace"]
+
+
+def test_stored_preference(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """test that the benchmark only runs once and failures are remembered"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    benchmarks: list[str] = []
+
+    def fake_benchmark() -> BackendPreference:
+        benchmarks.append("run")
+        return BackendPreference(
+            time.time(),
+            {
+                "userspace": BackendResult(0.2, 100.0),
+                "kernel": BackendResult(0.5, 900.0),
+            },
+        )
+
+    monkeypatch.setattr(tunnel_backend, "benchmark_backends", fake_benchmark)
+
+    assert [backend.name for backend in preferred_backends()] == [
+        "kernel",
+        "userspace",
+    ]
+    assert [backend.name for backend in preferred_backends()] == [
+        "kernel",
+        "userspace",
+    ]
+    assert benchmarks == ["run"]
+
+    backend_failed("kernel")
+    assert [backend.name for backend in preferred_backends()] == [
+        "userspace",
+        "kernel",
+    ]
+    assert benchmarks == ["run"]
+
+
+def test_failure_before_benchmark(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """a failure without stored preference should not count as a benchmark"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    def fake_benchmark() -> BackendPreference:
+        return BackendPreference(
+            time.time(),
+            {
+                "userspace": BackendResult(0.2, 900.0),
+                "kernel": BackendResult(0.5, 100.0),
+            },
+        )
+
+    monkeypatch.setattr(tunnel_backend, "benchmark_backends", fake_benchmark)
+
+    backend_failed("userspace")
+    assert [backend.name for backend in preferred_backends(benchmark=False)] == [
+        "kernel",
+        "userspace",
+    ]
+    assert [backend.name for backend in preferred_backends()] == [
+        "userspace",
+        "kernel",
+    ]
+
+
+def test_userspace_endpoints(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    """wireguard-go needs brackets around IPv6 endpoints"""
+    endpoints: list[str] = []
+
+    def fake_create(
+        pid: int, interface: str, config: WireguardConfig, tmpdir: Path
+    ) -> None:
+        peer = next(iter(config.peers.values()))
+        endpoints.append(f"{peer.endpoint_host}:{peer.endpoint_port}")
+
+    monkeypatch.setattr(tunnel_backend, "create_wireguard_tunnel", fake_create)
+
+    for endpoint in ["fd00::1:51820", "192.0.2.1:51820"]:
+        userspace_create_wireguard_tunnel(0, "wg-test", make_config(endpoint), tmp_path)
+    assert endpoints == ["[fd00::1]:51820", "192.0.2.1:51820"]
+
+    # hostnames are a problem with the configuration, not the backend
+    with pytest.raises(ValueError):
+        userspace_create_wireguard_tunnel(
+            0, "wg-test", make_config("cloudlet.invalid:51820"), tmp_path
+        )
+    assert len(endpoints) == 2
+
+
+@pytest.mark.skipif(
+    not can_unshare_with_tun(), reason="requires user namespaces and /dev/net/tun"
+)
+@pytest.mark.parametrize("host", ["127.0.0.1", "::1"])
+def test_benchmark_userspace(host: str) -> None:
+    result = benchmark_backend(BACKENDS["userspace"], size=4 * 1024 * 1024, host=host)
+    assert result.working
+    assert result.setup_time is not None and result.setup_time > 0